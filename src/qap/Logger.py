@@ -12,6 +12,8 @@ from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 
+from model import fuse_model
+
 if torch.cuda.is_available():
     dtype = torch.cuda.FloatTensor
     dtype_l = torch.cuda.LongTensor
@@ -65,6 +67,28 @@ class Logger(object):
         torch.save(model, path)
         print('Model Saved.')
 
+    def export_model(self, model, example):
+        """ Saves a TorchScript trace of model, with fused Gconv layers
+        (see fuse_model), for inference. example holds the graphs of a
+        sample batch as [W, x] pairs of dense tensors. The trace can be run
+        without this code, see inference.load_model. """
+        for W, x in example:
+            if not torch.is_tensor(W):
+                raise ValueError('Only dense operators can be exported.')
+        model = fuse_model(model)
+        example = tuple(tuple(g) for g in example)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        save_dir = os.path.join(self.path, 'parameters/')
+        # Create directory if necessary
+        try:
+            os.stat(save_dir)
+        except:
+            os.mkdir(save_dir)
+        path = os.path.join(save_dir, 'gnn_traced.pt')
+        traced.save(path)
+        print('Model exported to {}.'.format(path))
+
     def add_train_loss(self, loss):
         self.loss_train.append(loss.data.cpu().numpy())
 
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+import time
+import argparse
+
+import torch
+from data_generator import Generator, stack_examples
+from model import prepare_operators, gmul, Siamese_GNN
+from Logger import Logger
+import inference
+import tempfile
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_examples', nargs='?', const=1, type=int,
+                    default=200)
+parser.add_argument('--J', nargs='?', const=1, type=int, default=4)
+parser.add_argument('--num_features', nargs='?', const=1, type=int,
+                    default=20)
+parser.add_argument('--num_layers', nargs='?', const=1, type=int,
+                    default=20)
+
+###############################################################################
+#                            Reference implementations                        #
+###############################################################################
+
+def ErdosRenyi_loop(p, N):
+    # per-edge generator used before batched generation
+    W = np.zeros((N, N))
+    for i in range(0, N - 1):
+        for j in range(i + 1, N):
+            add_edge = (np.random.uniform(0, 1) < p)
+            if add_edge:
+                W[i, j] = 1
+            W[j, i] = W[i, j]
+    return W
+
+def compute_example_loop(gen):
+    W = ErdosRenyi_loop(gen.edge_density, gen.N)
+    noise = ErdosRenyi_loop(gen.noise, gen.N)
+    W_noise = W*(1-noise) + (1-W)*noise
+    WW, x = gen.compute_operators(W)
+    WW_noise, x_noise = gen.compute_operators(W_noise)
+    return {'WW': WW, 'x': x, 'WW_noise': WW_noise, 'x_noise': x_noise}
+
+def sample_batch_loop(gen, dataset, num_samples):
+    # per-example copies used before the batch was converted at once
+    num_examples = next(iter(dataset.values())).shape[0]
+    inds = np.random.randint(0, num_examples, num_samples)
+    rows = gen.read_rows(dataset, inds)
+    batch = {}
+    for field in ['WW', 'x', 'WW_noise', 'x_noise']:
+        batch[field] = torch.zeros(num_samples, *rows[field].shape[1:])
+        for b in range(num_samples):
+            batch[field][b] = torch.from_numpy(rows[field][b])
+    return batch
+
+def gmul_split_cat(input):
+    # graph multiply used before the operators were laid out once per forward
+    W, x = input
+    N = W.size()[-2]
+    W = W.split(1, 3)
+    W = torch.cat(W, 1).squeeze(3)
+    output = torch.bmm(W, x)
+    output = output.split(N, 1)
+    return torch.cat(output, 2)
+
+###############################################################################
+#                                  Benchmarks                                 #
+###############################################################################
+
+def benchmark_generation(gen, num_examples):
+    start = time.time()
+    for i in range(num_examples):
+        compute_example_loop(gen)
+    before = num_examples / (time.time() - start)
+    start = time.time()
+    for i in range(0, num_examples, gen.generation_batch):
+        gen.compute_examples(min(gen.generation_batch, num_examples - i))
+    after = num_examples / (time.time() - start)
+    return before, after
+
+def benchmark_operators(gen, num_examples):
+    W = gen.ErdosRenyi_batch(gen.edge_density, gen.N, gen.generation_batch)
+    start = time.time()
+    for i in range(0, num_examples, gen.generation_batch):
+        for b in range(W.shape[0]):
+            gen.compute_operators(W[b])
+    before = num_examples / (time.time() - start)
+    WW = np.empty([W.shape[0], gen.N, gen.N, gen.J + 2])
+    start = time.time()
+    for i in range(0, num_examples, gen.generation_batch):
+        gen.compute_operators_batch(W, WW=WW)
+    after = num_examples / (time.time() - start)
+    return before, after
+
+def benchmark_sampling(gen, dataset, batch_size, num_batches, cuda):
+    start = time.time()
+    for i in range(num_batches):
+        sample_batch_loop(gen, dataset, batch_size)
+    before = num_batches / (time.time() - start)
+    gen.data_train = dataset
+    start = time.time()
+    for i in range(num_batches):
+        gen.sample_batch(batch_size, cuda=cuda)
+    if cuda:
+        torch.cuda.synchronize()
+    after = num_batches / (time.time() - start)
+    return before, after
+
+def benchmark_gmul(W, x, num_layers):
+    """ Time per layer (ms) and peak GPU memory (MB, cuda only) of the graph
+    multiplies of a forward pass through num_layers layers. """
+    results = []
+    for version in ['split/cat', 'prepared']:
+        if W.is_cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.time()
+        if version == 'split/cat':
+            outputs = [gmul_split_cat([W, x]) for l in range(num_layers)]
+        else:
+            W_prepared = prepare_operators(W)
+            outputs = [gmul([W_prepared, x]) for l in range(num_layers)]
+        if W.is_cuda:
+            torch.cuda.synchronize()
+            peak = (torch.cuda.max_memory_allocated() - base) / 2.0**20
+            peak = '{:.1f}'.format(peak)
+        else:
+            peak = 'n/a'
+        elapsed = (time.time() - start) / num_layers * 1000
+        results.append(('{:.3f}'.format(elapsed), peak))
+        del outputs
+    return results
+
+def benchmark_latency(model, g1, g2, num_runs):
+    """ Milliseconds per forward in eval mode. """
+    with torch.no_grad():
+        model(g1, g2)
+        if g1[0].is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for i in range(num_runs):
+            model(g1, g2)
+        if g1[0].is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / num_runs * 1000
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    gen = Generator('')
+    gen.J = args.J
+    gen.noise_model = 1
+    template = '{:<10} {:<12} {:<18} {:<18}'
+    print(template.format('N', 'examples', 'loop (ex/s)', 'batched (ex/s)'))
+    for N in [50, 200, 1000]:
+        gen.N = N
+        # keep the (B, N, N) buffers of a batch around 100MB
+        gen.generation_batch = max(1, min(100, int(1e7 / N**2)))
+        num_examples = max(1, args.num_examples * 50**2 // N**2)
+        before, after = benchmark_generation(gen, num_examples)
+        print(template.format(N, num_examples, '{:.2f}'.format(before),
+                              '{:.2f}'.format(after)))
+    print('\nOperators')
+    print(template.format('N', 'examples', 'per graph (ex/s)',
+                          'batched (ex/s)'))
+    for N in [50, 200, 1000]:
+        gen.N = N
+        gen.generation_batch = max(1, min(100, int(1e7 / N**2)))
+        num_examples = gen.generation_batch * max(1, 500 // N)
+        before, after = benchmark_operators(gen, num_examples)
+        print(template.format(N, num_examples, '{:.2f}'.format(before),
+                              '{:.2f}'.format(after)))
+    print('\nSampling')
+    print(template.format('bs', 'storage', 'loop (batch/s)',
+                          'batched (batch/s)'))
+    gen.N = 50
+    gen.generation_batch = 100
+    cuda = torch.cuda.is_available()
+    for compact in [False, True]:
+        gen.compact = compact
+        dataset = stack_examples(gen.compute_examples(args.num_examples))
+        for bs in [1, 32, 256]:
+            num_batches = max(1, 2000 // bs)
+            before, after = benchmark_sampling(gen, dataset, bs, num_batches,
+                                               cuda)
+            print(template.format(bs, 'compact' if compact else 'dense',
+                                  '{:.2f}'.format(before),
+                                  '{:.2f}'.format(after)))
+    print('\nGraph multiply per layer, bs 32, {} layers'
+          .format(args.num_layers + 2))
+    print('{:<10} {:<12} {:<12} {:<12} {:<12}'.format(
+        'N', 'split/cat ms', 'prepared ms', 'split/cat MB', 'prepared MB'))
+    for N in [50, 200, 500]:
+        W = torch.rand(32, N, N, args.J + 2)
+        x = torch.rand(32, N, args.num_features)
+        if cuda:
+            W, x = W.cuda(), x.cuda()
+        (t0, m0), (t1, m1) = benchmark_gmul(W, x, args.num_layers + 2)
+        print('{:<10} {:<12} {:<12} {:<12} {:<12}'.format(N, t0, t1, m0, m1))
+    print('\nInference latency, N 50, {} layers'.format(args.num_layers + 2))
+    print('{:<10} {:<12} {:<12}'.format('bs', 'eager ms', 'exported ms'))
+    model = Siamese_GNN(args.num_features, args.num_layers, args.J + 2)
+    model.eval()
+    if cuda:
+        model.cuda()
+    path = tempfile.mkdtemp()
+    for bs in [1, 64]:
+        W = torch.rand(bs, 50, 50, args.J + 2)
+        x = torch.rand(bs, 50, 1)
+        if cuda:
+            W, x = W.cuda(), x.cuda()
+        Logger(path).export_model(model, [[W, x], [W, x]])
+        exported = inference.load_model(path + '/parameters/gnn_traced.pt',
+                                        cuda=cuda)
+        num_runs = 50 if bs == 1 else 10
+        eager = benchmark_latency(model, (W, x), (W, x), num_runs)
+        traced = benchmark_latency(exported, (W, x), (W, x), num_runs)
+        print('{:<10} {:<12.3f} {:<12.3f}'.format(bs, eager, traced))
@@ -5,6 +5,9 @@ import numpy as np
 import os
 # import dependencies
 import time
+import copy
+import shutil
+import multiprocessing
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -24,13 +27,16 @@ from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 
+from model import GraphOperators, prepare_operators, sparse_block_diagonal
+
 class Generator(object):
     def __init__(self, path_dataset):
         self.path_dataset = path_dataset
         self.num_examples_train = 10e6
         self.num_examples_test = 10e4
-        self.data_train = []
-        self.data_test = []
+        # datasets map every field to an array with one row per example
+        self.data_train = {}
+        self.data_test = {}
         self.J = 3
         self.N = 50
         self.generative_model = 'ErdosRenyi'
@@ -38,15 +44,38 @@ class Generator(object):
         self.random_noise = False
         self.noise = 0.03
         self.noise_model = 2
+        # number of graphs generated at once when building a dataset
+        self.generation_batch = 100
+        # compute the operators of a generation batch with batched matmuls
+        self.batch_operators = False
+        # store bit-packed adjacencies instead of operators, see pack_graphs
+        self.compact = False
+        # dataset seed and number of builder processes
+        self.seed = 0
+        self.num_workers = 1
+        # store only the powers and degrees of the operators
+        self.structured_operators = False
+        # feed the model sparse powers with closed-form Id/D/U operators;
+        # only power channels with a lower density than sparse_density are
+        # sparse, the others stay dense
+        self.sparse_operators = False
+        self.sparse_density = 0.1
+        # pinned host buffers reused to stage batches, see to_torch
+        self.buffers = {}
+        # host arrays reused across generation batches, see scratch
+        self.scratch_buffers = {}
 
     def ErdosRenyi(self, p, N):
-        W = np.zeros((N, N))
-        for i in range(0, N - 1):
-            for j in range(i + 1, N):
-                add_edge = (np.random.uniform(0, 1) < p)
-                if add_edge:
-                    W[i, j] = 1
-                W[j, i] = W[i, j]
+        return self.ErdosRenyi_batch(p, N, 1)[0]
+
+    def ErdosRenyi_batch(self, p, N, B):
+        """ Generate B Erdos-Renyi graphs as a (B, N, N) symmetric array.
+        p can be a scalar or an array with one edge probability per graph."""
+        p = np.reshape(p, [-1, 1, 1])
+        upper = np.triu(np.ones((N, N), dtype=bool), k=1)
+        W = (np.random.uniform(0, 1, [B, N, N]) < p) & upper
+        W = W.astype(float)
+        W += W.transpose(0, 2, 1)
         return W
 
     def ErdosRenyi_netx(self, p, N):
@@ -104,113 +133,416 @@ class Generator(object):
                              .format(self.generative_model))
         return WW, x
 
+    def scratch(self, name, shape):
+        """ A (B, ...) float array kept under name and reused by later calls
+        with the same trailing shape and at most B rows. """
+        array = self.scratch_buffers.get(name)
+        if (array is None or array.shape[1:] != tuple(shape[1:]) or
+                array.shape[0] < shape[0]):
+            array = np.empty(shape)
+            self.scratch_buffers[name] = array
+        return array[:shape[0]]
+
+    def compute_operators_batch(self, W, WW=None, buffer=None):
+        """ Batched version of compute_operators. W has size (B, N, N) and
+        the operators are written to WW, a (B, N, N, J+2) array. If WW is
+        not given it is the scratch array buffer, overwritten by the next
+        call with the same buffer, or a new array. x has size (B, N, 1)."""
+        if self.generative_model not in ['ErdosRenyi', 'Regular']:
+            raise ValueError('Generative model {} not implemented'
+                             .format(self.generative_model))
+        B, N = W.shape[0], W.shape[1]
+        if WW is None and buffer is not None:
+            WW = self.scratch(buffer, [B, N, N, self.J + 2])
+        elif WW is None:
+            WW = np.empty([B, N, N, self.J + 2])
+        diag = np.arange(N)
+        WW[:, :, :, 0] = 0
+        WW[:, diag, diag, 0] = 1
+        # operators: {Id, W, W^2, ..., D, U}. Channel J holds D, so only the
+        # powers stored in channels 1..J-1 are computed.
+        buffers = [self.scratch('QQ0', [B, N, N]),
+                   self.scratch('QQ1', [B, N, N])]
+        QQ = W
+        for j in range(self.J - 1):
+            WW[:, :, :, j + 1] = QQ
+            if j < self.J - 2:
+                QQ = np.matmul(QQ, QQ, out=buffers[j % 2])
+                np.minimum(QQ, 1, out=QQ)
+        if self.generative_model == 'ErdosRenyi':
+            d = W.sum(2)
+        elif self.J > 2:
+            # Regular: degrees of the thresholded W^2, stored in channel 2
+            d = WW[:, :, :, 2].sum(2)
+        else:
+            d = np.minimum(np.matmul(W, W), 1).sum(2)
+        WW[:, :, :, self.J] = 0
+        WW[:, diag, diag, self.J] = d
+        WW[:, :, :, self.J + 1] = 1.0 / float(N)
+        x = np.reshape(d, [B, N, 1])
+        return WW, x
+
+    def structure_operators(self, WW):
+        """ Splits a (..., N, N, J+2) operator stack into the powers of
+        channels 1..J-1 and the degree vector on the diagonal of channel J.
+        The identity and the mean operator need not be stored, the model
+        applies them in closed form (see GraphOperators). """
+        powers = np.ascontiguousarray(WW[..., 1:self.J])
+        degrees = np.diagonal(WW[..., self.J], axis1=-2, axis2=-1).copy()
+        return powers, degrees
+
+    def pack_graphs(self, W):
+        """ Bit-packs the upper triangles of a (B, N, N) stack of 0/1
+        adjacencies into a (B, ceil(N(N-1)/16)) uint8 array. """
+        rows, cols = np.triu_indices(self.N, k=1)
+        return np.packbits(W[:, rows, cols] > 0.5, axis=1)
+
+    def unpack_graphs(self, A):
+        """ Inverse of pack_graphs. """
+        rows, cols = np.triu_indices(self.N, k=1)
+        edges = np.unpackbits(A, axis=1, count=rows.shape[0])
+        W = np.zeros([A.shape[0], self.N, self.N])
+        W[:, rows, cols] = edges
+        W[:, cols, rows] = edges
+        return W
+
     def compute_example(self):
-        example = {}
+        example = self.compute_examples(1)[0]
+        return {field: np.array(example[field]) for field in example}
+
+    def compute_examples(self, B):
         if self.generative_model == 'ErdosRenyi':
-            W = self.ErdosRenyi_netx(self.edge_density, self.N)
+            W = self.ErdosRenyi_batch(self.edge_density, self.N, B)
         elif self.generative_model == 'Regular':
-            W = self.RegularGraph_netx(self.edge_density, self.N)
+            W = np.stack([self.RegularGraph_netx(self.edge_density, self.N)
+                          for b in range(B)])
         else:
             raise ValueError('Generative model {} not supported'
                              .format(self.generative_model))
         if self.random_noise:
-            self.noise = np.random.uniform(0.000, 0.050, 1)
+            noise = np.random.uniform(0.000, 0.050, B)
+        else:
+            noise = self.noise * np.ones(B)
         if self.noise_model == 1:
             # use noise model from [arxiv 1602.04181], eq (3.8)
-            noise = self.ErdosRenyi(self.noise, self.N)
+            noise = self.ErdosRenyi_batch(noise, self.N, B)
             W_noise = W*(1-noise) + (1-W)*noise
         elif self.noise_model == 2:
             # use noise model from [arxiv 1602.04181], eq (3.9)
-            pe1 = self.noise
-            pe2 = (self.edge_density*self.noise)/(1.0-self.edge_density)
-            noise1 = self.ErdosRenyi_netx(pe1, self.N)
-            noise2 = self.ErdosRenyi_netx(pe2, self.N)
+            pe1 = noise
+            pe2 = (self.edge_density*noise)/(1.0-self.edge_density)
+            noise1 = self.ErdosRenyi_batch(pe1, self.N, B)
+            noise2 = self.ErdosRenyi_batch(pe2, self.N, B)
             W_noise = W*(1-noise1) + (1-W)*noise2
         else:
             raise ValueError('Noise model {} not implemented'
                              .format(self.noise_model))
-        WW, x = self.compute_operators(W)
-        WW_noise, x_noise = self.compute_operators(W_noise)
-        example['WW'], example['x'] = WW, x
-        example['WW_noise'], example['x_noise'] = WW_noise, x_noise
-        return example
-
-    def create_dataset_train(self):
-        for i in range(self.num_examples_train):
-            example = self.compute_example()
-            self.data_train.append(example)
-
-    def create_dataset_test(self):
-        for i in range(self.num_examples_test):
-            example = self.compute_example()
-            self.data_test.append(example)
+        if self.compact:
+            # operators are computed in sample_batch
+            A, A_noise = self.pack_graphs(W), self.pack_graphs(W_noise)
+            return [{'A': A[b], 'A_noise': A_noise[b]} for b in range(B)]
+        if self.batch_operators:
+            # examples are views of the scratch arrays, valid until the
+            # next generation batch
+            WW, x = self.compute_operators_batch(W, buffer='WW')
+            WW_noise, x_noise = self.compute_operators_batch(
+                W_noise, buffer='WW_noise')
+        examples = []
+        for b in range(B):
+            example = {}
+            if self.batch_operators:
+                WW_b, x_b = WW[b], x[b]
+                WW_noise_b, x_noise_b = WW_noise[b], x_noise[b]
+            else:
+                WW_b, x_b = self.compute_operators(W[b])
+                WW_noise_b, x_noise_b = self.compute_operators(W_noise[b])
+            if self.structured_operators:
+                example['powers'], example['degrees'] = (
+                    self.structure_operators(WW_b))
+                example['powers_noise'], example['degrees_noise'] = (
+                    self.structure_operators(WW_noise_b))
+            else:
+                example['WW'], example['WW_noise'] = WW_b, WW_noise_b
+            example['x'], example['x_noise'] = x_b, x_noise_b
+            examples.append(example)
+        return examples
+
+    def compute_shard(self, split, shard, num_examples):
+        # every shard has its own seed, so a dataset only depends on the seed
+        # and not on the number of workers the shards are spread across
+        seed = np.random.SeedSequence([self.seed, split, shard])
+        seed = int(seed.generate_state(1)[0])
+        # the global generators are restored afterwards, so that sampling
+        # after building a dataset does not depend on the last shard
+        np_state, state = np.random.get_state(), random.getstate()
+        np.random.seed(seed)
+        random.seed(seed)
+        try:
+            return self.compute_examples(num_examples)
+        finally:
+            np.random.set_state(np_state)
+            random.setstate(state)
+
+    def create_dataset(self, num_examples, split, path=None):
+        shards = []
+        for i in range(0, num_examples, self.generation_batch):
+            B = min(self.generation_batch, num_examples - i)
+            shards.append((split, len(shards), B))
+        if self.num_workers > 1:
+            # workers get a copy of the generator without the datasets
+            gen = copy.copy(self)
+            gen.data_train, gen.data_test = {}, {}
+            gen.buffers, gen.scratch_buffers = {}, {}
+            pool = multiprocessing.Pool(self.num_workers,
+                                        initializer=init_worker,
+                                        initargs=(gen,))
+            examples_shards = pool.imap(compute_shard, shards)
+        else:
+            examples_shards = (self.compute_shard(*shard) for shard in shards)
+        if path is None:
+            # shards are stacked as they come, before the scratch arrays
+            # are reused by the next one
+            shards = [stack_examples(examples) for examples in examples_shards]
+            data = {field: np.concatenate([rows[field] for rows in shards])
+                    for field in shards[0]}
+        else:
+            data = self.write_dataset(path, examples_shards, num_examples)
+        if self.num_workers > 1:
+            pool.close()
+            pool.join()
+        return data
+
+    def write_dataset(self, path, examples_shards, num_examples):
+        """ Writes the dataset as one .npy file per field, filled shard by
+        shard, and returns it opened as memory maps. """
+        path_tmp = path + '.tmp'
+        if os.path.exists(path_tmp):
+            shutil.rmtree(path_tmp)
+        os.makedirs(path_tmp)
+        columns = {}
+        i = 0
+        for examples in examples_shards:
+            rows = stack_examples(examples)
+            for field in rows:
+                if field not in columns:
+                    path_field = os.path.join(path_tmp, field + '.npy')
+                    shape = (num_examples,) + rows[field].shape[1:]
+                    columns[field] = np.lib.format.open_memmap(
+                        path_field, mode='w+', dtype=rows[field].dtype,
+                        shape=shape)
+                columns[field][i:i + len(examples)] = rows[field]
+            i += len(examples)
+        for column in columns.values():
+            column.flush()
+        del columns
+        # only complete datasets get the final name
+        os.rename(path_tmp, path)
+        return self.read_dataset(path)
+
+    def read_dataset(self, path):
+        dataset = {}
+        for filename in sorted(os.listdir(path)):
+            field = os.path.splitext(filename)[0]
+            dataset[field] = np.load(os.path.join(path, filename),
+                                     mmap_mode='r')
+        return dataset
+
+    def create_dataset_train(self, path=None):
+        self.data_train = self.create_dataset(self.num_examples_train, 0,
+                                              path=path)
+
+    def create_dataset_test(self, path=None):
+        self.data_test = self.create_dataset(self.num_examples_test, 1,
+                                             path=path)
 
     def load_dataset(self):
+        # datasets are directories with one memory mapped .npy per field
         # load train dataset
         if self.random_noise:
-            filename = 'QAPtrain_RN.np'
+            filename = 'QAPtrain_RN'
         else:
-            filename = ('QAPtrain_{}_{}_{}.np'.format(self.generative_model,
+            filename = ('QAPtrain_{}_{}_{}'.format(self.generative_model,
                         self.noise, self.edge_density))
+        if self.compact:
+            filename += '_compact'
+        elif self.structured_operators:
+            filename += '_structured'
         path = os.path.join(self.path_dataset, filename)
         if os.path.exists(path):
             print('Reading training dataset at {}'.format(path))
-            self.data_train = np.load(open(path, 'rb'))
+            self.data_train = self.read_dataset(path)
         else:
             print('Creating training dataset.')
-            self.create_dataset_train()
             print('Saving training datatset at {}'.format(path))
-            np.save(open(path, 'wb'), self.data_train)
+            self.create_dataset_train(path=path)
         # load test dataset
         if self.random_noise:
-            filename = 'QAPtest_RN.np'
+            filename = 'QAPtest_RN'
         else:
-            filename = ('QAPtest_{}_{}_{}.np'.format(self.generative_model,
+            filename = ('QAPtest_{}_{}_{}'.format(self.generative_model,
                         self.noise, self.edge_density))
+        if self.compact:
+            filename += '_compact'
+        elif self.structured_operators:
+            filename += '_structured'
         path = os.path.join(self.path_dataset, filename)
         if os.path.exists(path):
             print('Reading testing dataset at {}'.format(path))
-            self.data_test = np.load(open(path, 'rb'))
+            self.data_test = self.read_dataset(path)
         else:
             print('Creating testing dataset.')
-            self.create_dataset_test()
             print('Saving testing datatset at {}'.format(path))
-            np.save(open(path, 'wb'), self.data_test)
+            self.create_dataset_test(path=path)
 
-    def sample_batch(self, num_samples, is_training=True,
-                     cuda=True, volatile=False):
-        WW_size = self.data_train[0]['WW'].shape
-        x_size = self.data_train[0]['x'].shape
+    def read_rows(self, dataset, inds):
+        """ Reads the examples inds of a dataset, computing the operators of
+        compact datasets on the fly. """
+        if 'A' in dataset:
+            W = self.unpack_graphs(dataset['A'][inds])
+            W_noise = self.unpack_graphs(dataset['A_noise'][inds])
+            rows = {}
+            rows['WW'], rows['x'] = self.compute_operators_batch(
+                W, buffer='WW')
+            rows['WW_noise'], rows['x_noise'] = (
+                self.compute_operators_batch(W_noise, buffer='WW_noise'))
+            if self.structured_operators or self.sparse_operators:
+                rows['powers'], rows['degrees'] = (
+                    self.structure_operators(rows.pop('WW')))
+                rows['powers_noise'], rows['degrees_noise'] = (
+                    self.structure_operators(rows.pop('WW_noise')))
+            if self.sparse_operators:
+                # the sparse adjacency is read from the bits, see graph_edges
+                rows['A'] = dataset['A'][inds]
+                rows['A_noise'] = dataset['A_noise'][inds]
+            return rows
+        return {field: dataset[field][inds] for field in dataset}
+
+    def to_torch(self, name, array, cuda):
+        """ Converts a batch to a float tensor. With cuda the batch is staged
+        in a pinned buffer kept under name and copied to the GPU without
+        blocking; the buffer is reused once that copy has finished. """
+        if not cuda:
+            return torch.from_numpy(np.asarray(array, dtype=np.float32))
+        buffer, copied = self.buffers.get(name, (None, None))
+        if buffer is None or tuple(buffer.size()) != array.shape:
+            buffer = torch.empty(array.shape, pin_memory=True)
+        else:
+            copied.synchronize()
+        buffer.numpy()[...] = array
+        tensor = buffer.cuda(non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record()
+        self.buffers[name] = (buffer, copied)
+        return tensor
+
+    def operators_to_torch(self, rows, suffix, cuda, volatile):
+        # dense (bs, N, N, J+2) operators or a GraphOperators when only the
+        # powers and degrees are stored
+        if self.sparse_operators:
+            return self.sparse_operators_to_torch(rows, suffix, cuda)
+        if 'powers' + suffix in rows:
+            powers = self.to_torch('powers' + suffix, rows['powers' + suffix],
+                                   cuda)
+            degrees = self.to_torch('degrees' + suffix,
+                                    rows['degrees' + suffix], cuda)
+            WW = GraphOperators(prepare_operators(powers), degrees)
+        else:
+            WW = self.to_torch('WW' + suffix, rows['WW' + suffix], cuda)
+            WW = Variable(WW, volatile=volatile)
+        return WW
 
-        WW = torch.zeros(WW_size).expand(num_samples, *WW_size)
-        X = torch.zeros(x_size).expand(num_samples, *x_size)
-        WW_noise = torch.zeros(WW_size).expand(num_samples, *WW_size)
-        X_noise = torch.zeros(x_size).expand(num_samples, *x_size)
+    def graph_edges(self, A):
+        """ Entries (batch, row, col) of the adjacencies bit-packed in A (see
+        pack_graphs), sorted by batch and row, without unpacking them to
+        dense matrices. """
+        rows, cols = np.triu_indices(self.N, k=1)
+        batch, edges = np.nonzero(np.unpackbits(A, axis=1,
+                                                count=rows.shape[0]))
+        batch = np.concatenate((batch, batch))
+        i = np.concatenate((rows[edges], cols[edges]))
+        j = np.concatenate((cols[edges], rows[edges]))
+        order = np.lexsort((j, i, batch))
+        return batch[order], i[order], j[order]
 
+    def sparse_operators_to_torch(self, rows, suffix, cuda):
+        """ GraphOperators where the power channels with a density below
+        sparse_density are block-diagonal sparse matrices built from their
+        nonzero entries, and runs of the other channels stay dense. """
+        if 'powers' + suffix in rows:
+            powers = rows['powers' + suffix]
+            degrees = rows['degrees' + suffix]
+        else:
+            powers, degrees = self.structure_operators(rows['WW' + suffix])
+        B, N = degrees.shape
+        device = 'cuda' if cuda else 'cpu'
+        blocks = []
+        start = 0 # first channel of the current dense run
+        num_channels = powers.shape[-1]
+        for j in range(num_channels + 1):
+            if j < num_channels:
+                channel = powers[..., j]
+                density = np.count_nonzero(channel) / float(channel.size)
+                if density >= self.sparse_density:
+                    continue
+            if j > start:
+                name = 'powers{}_{}'.format(suffix, start)
+                dense = np.ascontiguousarray(powers[..., start:j])
+                blocks.append(prepare_operators(
+                    self.to_torch(name, dense, cuda)))
+            start = j + 1
+            if j == num_channels:
+                break
+            if j == 0 and 'A' + suffix in rows:
+                entries = self.graph_edges(rows['A' + suffix])
+                values = None
+            else:
+                entries = np.nonzero(channel)
+                values = torch.from_numpy(
+                    channel[entries].astype(np.float32)).to(device)
+            batch, i, k = [torch.from_numpy(index).long().to(device)
+                           for index in entries]
+            blocks.append(sparse_block_diagonal(batch, i, k, B, N,
+                                                values=values))
+        degrees = self.to_torch('degrees' + suffix, degrees, cuda)
+        return GraphOperators(blocks, degrees)
+
+    def sample_batch(self, num_samples, is_training=True,
+                     cuda=True, volatile=False):
         if is_training:
             dataset = self.data_train
         else:
-            datatset = self.data_test
-        for b in range(num_samples):
-            ind = np.random.randint(0, len(dataset))
-            ww = torch.from_numpy(dataset[ind]['WW'])
-            x = torch.from_numpy(dataset[ind]['x'])
-            WW[b] = ww
-            X[b] = x
-            ww_noise = torch.from_numpy(dataset[ind]['WW_noise'])
-            x_noise = torch.from_numpy(dataset[ind]['x_noise'])
-            WW_noise[b] = ww_noise
-            X_noise[b] = x_noise
-        
-        WW = Variable(WW, volatile=volatile)
+            dataset = self.data_test
+        num_examples = next(iter(dataset.values())).shape[0]
+        inds = np.random.randint(0, num_examples, num_samples)
+        rows = self.read_rows(dataset, inds)
+        return self.batch_from_rows(rows, cuda=cuda, volatile=volatile)
+
+    def batch_from_rows(self, rows, cuda=True, volatile=False):
+        """ Turns a dictionary of (num_samples, ...) operator arrays into the
+        pair of graph inputs expected by the model. """
+        WW = self.operators_to_torch(rows, '', cuda, volatile)
+        X = self.to_torch('x', rows['x'], cuda)
+        WW_noise = self.operators_to_torch(rows, '_noise', cuda, volatile)
+        X_noise = self.to_torch('x_noise', rows['x_noise'], cuda)
         X = Variable(X, volatile=volatile)
-        WW_noise = Variable(WW_noise, volatile=volatile)
         X_noise = Variable(X_noise, volatile=volatile)
+        return [WW, X], [WW_noise, X_noise]
 
-        if cuda:
-            return [WW.cuda(), X.cuda()], [WW_noise.cuda(), X_noise.cuda()]
-        else:
-            return [WW, X], [WW_noise, X_noise]
+###############################################################################
+#                           Dataset builder helpers                           #
+###############################################################################
+
+def stack_examples(examples):
+    # list of examples -> dictionary of (num_examples, ...) arrays
+    return {field: np.stack([example[field] for example in examples])
+            for field in examples[0]}
+
+def init_worker(gen):
+    global worker_gen
+    worker_gen = gen
+
+def compute_shard(shard):
+    return worker_gen.compute_shard(*shard)
 
 if __name__ == '__main__':
     ###################### Test Generator module ##############################
@@ -0,0 +1,26 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Runs models exported with Logger.export_model. Only torch is needed, the
+# traced graph does not depend on the training code.
+
+import torch
+
+
+def load_model(path, cuda=False):
+    device = 'cuda' if cuda else 'cpu'
+    return torch.jit.load(path, map_location=device)
+
+def match_graphs(model, g1, g2):
+    # g1 and g2 are (W, x) pairs of dense tensors, the output has size
+    # (bs, N, N) and row i scores the nodes of g2 matched to node i of g1
+    with torch.no_grad():
+        return model(tuple(g1), tuple(g2))
+
+if __name__ == '__main__':
+    import sys
+    model = load_model(sys.argv[1])
+    bs, N, J = 1, 50, 6
+    W = torch.rand(bs, N, N, J)
+    x = torch.rand(bs, N, 1)
+    print(match_graphs(model, (W, x), (W, x)).size())
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import copy
+import queue
+import random
+import threading
+import multiprocessing
+import numpy as np
+
+from data_generator import stack_examples
+
+
+class Prefetcher(object):
+    """ Assembles training batches of a Generator in a background thread and
+    keeps up to depth of them ready in a bounded queue, so that sampling the
+    next batch overlaps with the model step on the current one. """
+    def __init__(self, gen, batch_size, depth=2, cuda=True):
+        # the producer gets its own staging buffers so that batches sampled
+        # from the main thread (e.g. for testing) never share them
+        self.gen = copy.copy(gen)
+        self.gen.buffers, self.gen.scratch_buffers = {}, {}
+        self.batch_size = batch_size
+        self.cuda = cuda
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        try:
+            while not self.stopped.is_set():
+                self.put(self.gen.sample_batch(self.batch_size,
+                                               cuda=self.cuda))
+        except Exception as error:
+            # handed over to the consumer, which raises it on next()
+            self.put(error)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        return self
+
+    __next__ = next
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class StreamingLoader(object):
+    """ Trains on fresh examples instead of a fixed dataset: num_workers
+    processes keep generating batches of (graph, noisy graph) pairs with
+    Generator.compute_examples and push them to a bounded queue. Worker w
+    is seeded from (gen.seed, 2, w), split 2 being unused by the datasets,
+    so the batches of every worker only depend on the seed (the order in
+    which workers deliver them does not). """
+    def __init__(self, gen, batch_size, num_workers=1, depth=4, cuda=True):
+        self.gen = gen
+        self.cuda = cuda
+        # workers get a copy of the generator without the datasets
+        worker_gen = copy.copy(gen)
+        worker_gen.data_train, worker_gen.data_test = {}, {}
+        worker_gen.buffers, worker_gen.scratch_buffers = {}, {}
+        worker_gen.compact = False
+        self.queue = multiprocessing.Queue(maxsize=depth)
+        self.stopped = multiprocessing.Event()
+        self.workers = []
+        for w in range(num_workers):
+            worker = multiprocessing.Process(
+                target=stream_worker,
+                args=(worker_gen, batch_size, w, self.queue, self.stopped))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def next(self, volatile=False):
+        rows = self.queue.get()
+        if isinstance(rows, Exception):
+            raise rows
+        return self.gen.batch_from_rows(rows, cuda=self.cuda,
+                                        volatile=volatile)
+
+    def __iter__(self):
+        return self
+
+    __next__ = next
+
+    def close(self):
+        self.stopped.set()
+        # drain the queue so that workers blocked on put can exit
+        while any(worker.is_alive() for worker in self.workers):
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for worker in self.workers:
+            worker.join()
+
+
+def stream_worker(gen, batch_size, worker, out, stopped):
+    seed = np.random.SeedSequence([gen.seed, 2, worker])
+    seed = int(seed.generate_state(1)[0])
+    np.random.seed(seed)
+    random.seed(seed)
+    try:
+        while not stopped.is_set():
+            rows = stack_examples(gen.compute_examples(batch_size))
+            # halves the pickled size, batches are float32 on the model side
+            rows = {field: rows[field].astype(np.float32) for field in rows}
+            while not stopped.is_set():
+                try:
+                    out.put(rows, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+    except Exception as error:
+        out.put(error)
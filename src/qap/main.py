@@ -4,7 +4,8 @@
 import numpy as np
 import os
 # import dependencies
-from data_generator import Generator
+from data_generator import Generator, stack_examples
+from loader import Prefetcher, StreamingLoader
 from model import Siamese_GNN
 from Logger import Logger
 import time
@@ -36,6 +37,12 @@ parser.add_argument('--num_examples_train', nargs='?', const=1, type=int,
                     default=int(20000))
 parser.add_argument('--num_examples_test', nargs='?', const=1, type=int,
                     default=int(1000))
+parser.add_argument('--batch_operators', action='store_true')
+parser.add_argument('--generation_batch', nargs='?', const=1, type=int,
+                    default=100)
+parser.add_argument('--num_workers', nargs='?', const=1, type=int, default=1)
+parser.add_argument('--compact_dataset', action='store_true')
+parser.add_argument('--dataset_seed', nargs='?', const=1, type=int, default=0)
 parser.add_argument('--edge_density', nargs='?', const=1, type=float,
                     default=0.2)
 parser.add_argument('--random_noise', action='store_true')
@@ -43,6 +50,13 @@ parser.add_argument('--noise', nargs='?', const=1, type=float, default=0.03)
 parser.add_argument('--noise_model', nargs='?', const=1, type=int, default=2)
 parser.add_argument('--generative_model', nargs='?', const=1, type=str,
                     default='ErdosRenyi')
+parser.add_argument('--stream', action='store_true')
+parser.add_argument('--sparse_operators', action='store_true')
+parser.add_argument('--sparse_density', nargs='?', const=1, type=float,
+                    default=0.1)
+parser.add_argument('--structured_operators', action='store_true')
+parser.add_argument('--export', action='store_true')
+parser.add_argument('--prefetch', nargs='?', const=1, type=int, default=0)
 parser.add_argument('--iterations', nargs='?', const=1, type=int,
                     default=int(60000))
 parser.add_argument('--batch_size', nargs='?', const=1, type=int, default=1)
@@ -61,6 +75,7 @@ parser.add_argument('--clip_grad_norm', nargs='?', const=1, type=float,
 
 parser.add_argument('--num_features', nargs='?', const=1, type=int,
                     default=20)
+parser.add_argument('--siamese_batched', action='store_true')
 parser.add_argument('--num_layers', nargs='?', const=1, type=int,
                     default=20)
 parser.add_argument('--J', nargs='?', const=1, type=int, default=4)
@@ -90,9 +105,24 @@ def train(siamese_gnn, logger, gen):
     labels = (Variable(torch.arange(0, gen.N).unsqueeze(0).expand(batch_size,
               gen.N)).type(dtype_l))
     optimizer = torch.optim.Adamax(siamese_gnn.parameters(), lr=1e-3)
+    loader = None
+    if args.stream:
+        # fresh examples from num_workers generator processes, queued two
+        # batches deep unless --prefetch is given
+        loader = StreamingLoader(gen, batch_size,
+                                 num_workers=max(1, args.num_workers),
+                                 depth=args.prefetch or 2,
+                                 cuda=torch.cuda.is_available())
+    elif args.prefetch > 0:
+        loader = Prefetcher(gen, batch_size, depth=args.prefetch,
+                            cuda=torch.cuda.is_available())
     for it in range(args.iterations):
         start = time.time()
-        input = gen.sample_batch(batch_size, cuda=torch.cuda.is_available())
+        if loader is not None:
+            input = loader.next()
+        else:
+            input = gen.sample_batch(batch_size,
+                                     cuda=torch.cuda.is_available())
         pred = siamese_gnn(*input)
         loss = compute_loss(pred, labels)
         siamese_gnn.zero_grad()
@@ -116,18 +146,29 @@ def train(siamese_gnn, logger, gen):
         if it % logger.args['save_freq'] == 0:
             logger.save_model(siamese_gnn)
             logger.save_results()
+    if loader is not None:
+        loader.close()
     print('Optimization finished.')
 
 if __name__ == '__main__':
     logger = Logger(args.path_logger)
     logger.write_settings(args)
-    siamese_gnn = Siamese_GNN(args.num_features, args.num_layers, args.J + 2)
+    siamese_gnn = Siamese_GNN(args.num_features, args.num_layers, args.J + 2,
+                              batched=args.siamese_batched)
     if torch.cuda.is_available():
         siamese_gnn.cuda()
     gen = Generator(args.path_dataset)
     # generator setup
     gen.num_examples_train = args.num_examples_train
     gen.num_examples_test = args.num_examples_test
+    gen.batch_operators = args.batch_operators
+    gen.generation_batch = args.generation_batch
+    gen.num_workers = args.num_workers
+    gen.seed = args.dataset_seed
+    gen.compact = args.compact_dataset
+    gen.sparse_operators = args.sparse_operators
+    gen.sparse_density = args.sparse_density
+    gen.structured_operators = args.structured_operators
     gen.J = args.J
     gen.edge_density = args.edge_density
     gen.random_noise = args.random_noise
@@ -136,8 +177,21 @@ if __name__ == '__main__':
     gen.generative_model = args.generative_model
     # load dataset
     # print(gen.random_noise)
-    gen.load_dataset()
+    if not args.stream:
+        gen.load_dataset()
     if args.mode == 'train':
         train(siamese_gnn, logger, gen)
     # elif args.mode == 'test':
     #     test(siamese_gnn, logger, gen)
+    if args.export:
+        # traced on a sample batch, see Logger.export_model
+        if args.stream:
+            # no test dataset is loaded when streaming
+            rows = stack_examples(gen.compute_examples(batch_size))
+            rows = gen.read_rows(rows, np.arange(batch_size))
+            example = gen.batch_from_rows(rows,
+                                          cuda=torch.cuda.is_available())
+        else:
+            example = gen.sample_batch(batch_size, is_training=False,
+                                       cuda=torch.cuda.is_available())
+        logger.export_model(siamese_gnn, example)
@@ -9,6 +9,7 @@ import unicodedata
 import string
 import re
 import random
+import copy
 
 import torch
 import torch.nn as nn
@@ -35,20 +36,120 @@ def sinkhorn_knopp(A, iterations=1):
         A = A.view(*A_size).permute(0, 2, 1)
     return A
 
+def prepare_operators(W):
+    # W is a tensor of size (bs, N, N, J). Row n*J + j of the result is row n
+    # of operator j, so the product with x is already laid out as
+    # (bs, N, J*num_features) and no split/cat is needed.
+    W_size = W.size()
+    W = W.permute(0, 1, 3, 2).contiguous()
+    return W.view(W_size[0], W_size[1]*W_size[3], W_size[2])
+
+def sparse_block_diagonal(batch, rows, cols, bs, N, values=None):
+    """ The (bs*N, bs*N) block-diagonal CSR matrix of a batch of sparse
+    (N, N) matrices given by the entries (batch, rows, cols), which must be
+    sorted by batch and row (as np.nonzero returns them). A single sparse
+    matmul then multiplies the whole batch. """
+    device = batch.device
+    rows = batch * N + rows
+    if values is None:
+        values = torch.ones(rows.size(0), device=device)
+    counts = torch.bincount(rows, minlength=bs * N)
+    crow = torch.cat((torch.zeros(1, dtype=torch.long, device=device),
+                      torch.cumsum(counts, 0)))
+    return torch.sparse_csr_tensor(crow, batch * N + cols, values,
+                                   size=(bs * N, bs * N))
+
+def cat_block_diagonal(matrices):
+    # block-diagonal CSR matrices of several batches -> one for all of them
+    crow, cols, values = [], [], []
+    nnz, size = 0, 0
+    for i, matrix in enumerate(matrices):
+        offsets = matrix.crow_indices() + nnz
+        crow.append(offsets if i == 0 else offsets[1:])
+        cols.append(matrix.col_indices() + size)
+        values.append(matrix.values())
+        nnz += matrix.values().size(0)
+        size += matrix.size(0)
+    return torch.sparse_csr_tensor(torch.cat(crow), torch.cat(cols),
+                                   torch.cat(values), size=(size, size))
+
+class GraphOperators(object):
+    """ Operators {Id, W, W^2, ..., W^{J-1}, D, U} of a batch of graphs where
+    only the powers are stored, laid out as in prepare_operators in a dense
+    (bs, N*(J-1), N) tensor. The identity, the degree operator D = diag(d)
+    and the mean operator U = ones/N are applied in closed form.
+
+    The powers can also be a list of blocks of consecutive channels, each
+    either a dense (bs, N*k, N) tensor laid out as above or a single
+    channel stored as a block-diagonal sparse CSR matrix (see
+    sparse_block_diagonal). Only sparse channels (typically the adjacency)
+    gain from this; a graph multiply costs O(E F) for each of them. """
+    def __init__(self, powers, degrees):
+        self.powers = powers
+        # degrees is a tensor of size (bs, N)
+        self.degrees = degrees
+
+    @staticmethod
+    def from_dense(W):
+        # W is a tensor of size (bs, N, N, J+2) from compute_operators
+        J = W.size()[-1] - 2
+        powers = prepare_operators(W[:, :, :, 1:J])
+        degrees = torch.diagonal(W[:, :, :, J], dim1=1, dim2=2)
+        return GraphOperators(powers, degrees)
+
+    def blocks(self):
+        if isinstance(self.powers, list):
+            return self.powers
+        return [self.powers]
+
+    @staticmethod
+    def cat(operators):
+        # concatenates GraphOperators along the batch dimension
+        degrees = torch.cat([ops.degrees for ops in operators], 0)
+        blocks = []
+        for block in zip(*[ops.blocks() for ops in operators]):
+            if block[0].layout == torch.sparse_csr:
+                blocks.append(cat_block_diagonal(block))
+            else:
+                blocks.append(torch.cat(block, 0))
+        if not isinstance(operators[0].powers, list):
+            blocks = blocks[0]
+        return GraphOperators(blocks, degrees)
+
+    def cuda(self):
+        if isinstance(self.powers, list):
+            powers = [block.cuda() for block in self.powers]
+        else:
+            powers = self.powers.cuda()
+        return GraphOperators(powers, self.degrees.cuda())
+
+    def mul(self, x):
+        # x is a tensor of size (bs, N, num_features)
+        x_size = x.size()
+        out = [x]
+        for block in self.blocks():
+            if block.layout == torch.sparse_csr:
+                flat = x.reshape(x_size[0] * x_size[1], x_size[2])
+                out.append(torch.mm(block, flat).view(*x_size))
+            else:
+                out.append(torch.bmm(block, x).view(x_size[0], x_size[1], -1))
+        out.append(self.degrees.unsqueeze(2) * x)
+        out.append(x.mean(1, keepdim=True).expand_as(x))
+        # same feature order as the dense operator stack
+        return torch.cat(out, 2)
+
 def gmul(input):
     W, x = input
     # x is a tensor of size (bs, N, num_features)
-    # W is a tensor of size (bs, N, N, J)
+    # W is a tensor of size (bs, N*J, N), see prepare_operators, the raw
+    # (bs, N, N, J) operators or a GraphOperators
+    if isinstance(W, GraphOperators):
+        return W.mul(x)
+    if W.dim() == 4:
+        W = prepare_operators(W)
     x_size = x.size()
-    W_size = W.size()
-    N = W_size[-2]
-    J = W_size[-1]
-    W = W.split(1, 3)
-    W = torch.cat(W, 1).squeeze(3) # W is now a tensor of size (bs, J*N, N)
-    output = torch.bmm(W, x) # output has size (bs, J*N, num_features)
-    output = output.split(N, 1)
-    output = torch.cat(output, 2) # output has size (bs, N, J*num_features)
-    return output
+    output = torch.bmm(W, x) # output has size (bs, N*J, num_features)
+    return output.view(x_size[0], x_size[1], -1) # (bs, N, J*num_features)
 
 class Gconv_last(nn.Module):
     def __init__(self, feature_maps, J):
@@ -89,6 +190,55 @@ class Gconv(nn.Module):
         x = x.view(*x_size[:-1], self.num_outputs)
         return W, x
 
+class Gconv_fused(nn.Module):
+    """ Eval-mode Gconv doing one GEMM: fc1 and fc2 are packed into a single
+    linear layer with the BatchNorm folded into its weights. The normalized
+    relu half is s*relu(z) + t = sign(s)*relu(|s|*z) + t, so only |s| can
+    be folded there and sign and t are applied afterwards, together with
+    the identity on the linear half, in a single addcmul. """
+    def __init__(self, gconv):
+        super(Gconv_fused, self).__init__()
+        self.num_inputs = gconv.num_inputs
+        self.num_outputs = gconv.num_outputs
+        self.half = self.num_outputs // 2
+        bn = gconv.bn
+        scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias.data - bn.running_mean * scale
+        h = self.half
+        # relu half scaled by |s|, linear half by s and shifted by t
+        folded = torch.cat((scale[:h].abs(), scale[h:]))
+        weight = torch.cat((gconv.fc1.weight.data, gconv.fc2.weight.data))
+        bias = torch.cat((gconv.fc1.bias.data, gconv.fc2.bias.data))
+        self.fc = nn.Linear(self.num_inputs, self.num_outputs)
+        self.fc.weight.data = weight * folded[:, None]
+        self.fc.bias.data = bias * folded
+        self.fc.bias.data[h:] += shift[h:]
+        sign = torch.ones(self.num_outputs)
+        sign[:h] = torch.sign(scale[:h])
+        self.register_buffer('sign', sign)
+        self.register_buffer('shift', torch.cat((shift[:h],
+                                                 torch.zeros(h))))
+
+    def forward(self, input):
+        W = input[0]
+        x = gmul(input) # out has size (bs, N, num_inputs)
+        x_size = x.size()
+        x = self.fc(x.view(-1, self.num_inputs))
+        x[:, :self.half] = F.relu(x[:, :self.half])
+        x = torch.addcmul(self.shift, x, self.sign)
+        x = x.view(*x_size[:-1], self.num_outputs)
+        return W, x
+
+def fuse_model(model):
+    """ Inference copy of a trained model in eval mode where every Gconv is
+    replaced by a Gconv_fused. """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Gconv):
+                setattr(module, name, Gconv_fused(child))
+    return model
+
 class GNN(nn.Module):
     def __init__(self, num_features, num_layers, J):
         super(GNN, self).__init__()
@@ -104,6 +254,9 @@ class GNN(nn.Module):
         self.layerlast = Gconv_last(self.featuremap_end, J)
 
     def forward(self, input):
+        # the operators are laid out for bmm once and shared by all layers
+        if not isinstance(input[0], GraphOperators):
+            input = [prepare_operators(input[0]), input[1]]
         cur = self.layer0(input)
         for i in range(self.num_layers):
             cur = self._modules['layer{}'.format(i+1)](cur)
@@ -111,13 +264,28 @@ class GNN(nn.Module):
         return out[1]
 
 class Siamese_GNN(nn.Module):
-    def __init__(self, num_features, num_layers, J):
+    """ With batched, g1 and g2 are concatenated along the batch dimension
+    and embedded in a single GNN pass. In training mode BatchNorm then
+    normalizes with the joint statistics of both graphs instead of per
+    graph, and its running statistics are updated once per forward instead
+    of twice. Evaluation is unaffected since it uses the running stats. """
+    def __init__(self, num_features, num_layers, J, batched=False):
         super(Siamese_GNN, self).__init__()
         self.gnn = GNN(num_features, num_layers, J)
+        self.batched = batched
 
     def forward(self, g1, g2):
-        emb1 = self.gnn(g1)
-        emb2 = self.gnn(g2)
+        if self.batched:
+            bs = g1[1].size()[0]
+            if isinstance(g1[0], GraphOperators):
+                W = GraphOperators.cat([g1[0], g2[0]])
+            else:
+                W = torch.cat((g1[0], g2[0]), 0)
+            emb = self.gnn([W, torch.cat((g1[1], g2[1]), 0)])
+            emb1, emb2 = emb[:bs], emb[bs:]
+        else:
+            emb1 = self.gnn(g1)
+            emb2 = self.gnn(g2)
         # embx are tensors of size (bs, N, num_features)
         out = torch.bmm(emb1, emb2.permute(0, 2, 1))
         return out # out has size (bs, N, N)
@@ -149,6 +317,31 @@ if __name__ == '__main__':
     # gnn = GNN(num_features, num_layers, J)
     # out = gnn(input)
     # print(out.size())
+    ######################### test graph operators #########################
+    # WW = torch.rand(bs, N, N, 6)
+    # WW[:, :, :, 0] = torch.eye(N)
+    # WW[:, :, :, 4] = torch.diag_embed(torch.rand(bs, N))
+    # WW[:, :, :, 5] = 1.0 / N
+    # ops = GraphOperators.from_dense(WW)
+    # b, i, j = torch.nonzero(WW[:, :, :, 1], as_tuple=True)
+    # ops.powers = [sparse_block_diagonal(b, i, j, bs, N, WW[b, i, j, 1]),
+    #               prepare_operators(WW[:, :, :, 2:4])]
+    # print((gmul([ops, x]) - gmul([WW, x])).abs().max())
+    ######################### test fused gconv ############################
+    siamese_gnn = Siamese_GNN(num_features, num_layers, J)
+    # non trivial batch norm statistics, including negative scales
+    for module in siamese_gnn.modules():
+        if isinstance(module, nn.BatchNorm1d):
+            module.weight.data.normal_()
+            module.bias.data.normal_()
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2)
+    siamese_gnn.eval()
+    x = torch.rand((bs, N, 1))
+    input1 = [Variable(W), Variable(x)]
+    out = siamese_gnn(input1, input1)
+    out_fused = fuse_model(siamese_gnn)(input1, input1)
+    print('fused error', ((out - out_fused).abs().max() / out.abs().max()))
     ######################### test siamese gnn ##############################
     x = torch.ones((bs, N, 1))
     input1 = [Variable(W), Variable(x)]
@@ -2,8 +2,13 @@
 # -*- coding: UTF-8 -*-
 
 import numpy as np
-from subprocess import Popen, PIPE, STDOUT, call
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired, call
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import hashlib
 import os
+import shutil
+import tempfile
 import time
 import matplotlib
 matplotlib.use('Agg')
@@ -21,6 +26,13 @@ class TSP(object):
         self.C = 10e4
         self.path_solver = path_tsp
         self.path_datatsp = path_tsp + 'DATA/'
+        # parent directory of the scratch directories used by solve
+        self.path_scratch = None
+        # LKH parameters written to every .par file
+        self.move_type = 5
+        self.patching_c = 3
+        self.patching_a = 2
+        self.runs = 10
         # export LKH_PATH
         cmd = "export LKH_PATH='{}'".format(self.path_solver)
         p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
@@ -76,23 +88,21 @@ class TSP(object):
                 labels[perm[i]] = perm[i+1]
         return labels
 
-    def save_solverformat(self, example, id, mode='CEIL_2D'):
+    def save_solverformat(self, example, id, mode='CEIL_2D', path_dir=None):
+        if path_dir is None:
+            path_dir = self.path_datatsp
         if mode == 'CEIL_2D':
-            path_par = os.path.join(self.path_datatsp, 'pr{}.par'.format(id))
-            path_tsp = os.path.join(self.path_datatsp, 'pr{}.tsp'.format(id))
-            path_res = os.path.join(self.path_datatsp, 'res{}.tsp'.format(id))
+            path_par = os.path.join(path_dir, 'pr{}.par'.format(id))
+            path_tsp = os.path.join(path_dir, 'pr{}.tsp'.format(id))
+            path_res = os.path.join(path_dir, 'res{}.tsp'.format(id))
             # create .par file
             with open(path_par, 'w+') as file:
-                MOVE_TYPE = 5
-                PATCHING_C = 3
-                PATCHING_A = 2
-                RUNS = 10
                 TOUR_FILE = path_res
                 HEADER = [path_tsp,
-                          MOVE_TYPE,
-                          PATCHING_C,
-                          PATCHING_A,
-                          RUNS,
+                          self.move_type,
+                          self.patching_c,
+                          self.patching_a,
+                          self.runs,
                           TOUR_FILE]
                 HEADER = self.header_temp_par.format(*HEADER)
                 file.write(HEADER)
@@ -111,21 +121,17 @@ class TSP(object):
                     file.write(node)
                 file.write('EOF \n')
         elif mode == 'EXPLICIT':
-            path_par = os.path.join(self.path_datatsp, 'pr{}.par'.format(id))
-            path_tsp = os.path.join(self.path_datatsp, 'pr{}.tsp'.format(id))
-            path_res = os.path.join(self.path_datatsp, 'res{}.tsp'.format(id))
+            path_par = os.path.join(path_dir, 'pr{}.par'.format(id))
+            path_tsp = os.path.join(path_dir, 'pr{}.tsp'.format(id))
+            path_res = os.path.join(path_dir, 'res{}.tsp'.format(id))
             # create .par file
             with open(path_par, 'w+') as file:
-                MOVE_TYPE = 5
-                PATCHING_C = 3
-                PATCHING_A = 2
-                RUNS = 10
                 TOUR_FILE = path_res
                 HEADER = [path_tsp,
-                          MOVE_TYPE,
-                          PATCHING_C,
-                          PATCHING_A,
-                          RUNS,
+                          self.move_type,
+                          self.patching_c,
+                          self.patching_a,
+                          self.runs,
                           TOUR_FILE]
                 HEADER = self.header_temp_par.format(*HEADER)
                 file.write(HEADER)
@@ -148,19 +154,27 @@ class TSP(object):
         else:
             raise ValueError('TSP mode {} not supported.'.format(mode))
 
-    def tsp_solver(self, id):
+    def tsp_solver(self, id, path_dir=None, timeout=None):
+        if path_dir is None:
+            path_dir = self.path_datatsp
         path_exec = os.path.join(self.path_solver, 'LKH')
-        path_example = os.path.join(self.path_datatsp, 'pr{}.par'.format(id))
-        cmd = "{} {}".format(path_exec, path_example)
-        p = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT,
-                  close_fds=True)
-        output = p.stdout.read()
+        path_example = os.path.join(path_dir, 'pr{}.par'.format(id))
+        p = Popen([path_exec, path_example], stdin=PIPE, stdout=PIPE,
+                  stderr=STDOUT, close_fds=True)
+        try:
+            output = p.communicate(timeout=timeout)[0]
+        except TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise
         return output
 
-    def extract_path(self, id):
+    def extract_path(self, id, path_dir=None):
+        if path_dir is None:
+            path_dir = self.path_datatsp
         ham_cycle = []
         length_tour = 0
-        path_res = os.path.join(self.path_datatsp, 'res{}.tsp'.format(id))
+        path_res = os.path.join(path_dir, 'res{}.tsp'.format(id))
         with open(path_res, 'r') as file:
             content = file.readlines()
             tour = content[1]
@@ -172,6 +186,28 @@ class TSP(object):
         ham_cycle = np.array(ham_cycle) - 1
         return ham_cycle, length_tour
 
+    def instance_key(self, example, mode='CEIL_2D'):
+        """ Hash of the instance as written for LKH (the integer coordinates
+        or weights) and of the solver parameters. """
+        example_int = (example * self.C).astype(np.int64)
+        params = [self.move_type, self.patching_c, self.patching_a, self.runs]
+        key = hashlib.sha1()
+        key.update(mode.encode())
+        key.update(np.array(params + list(example_int.shape)).tobytes())
+        key.update(example_int.tobytes())
+        return key.hexdigest()
+
+    def solve(self, example, mode='CEIL_2D', timeout=None):
+        """ Solve one instance in a scratch directory of its own, so that
+        several solves can run at the same time. """
+        path_dir = tempfile.mkdtemp(prefix='lkh', dir=self.path_scratch)
+        try:
+            self.save_solverformat(example, 0, mode=mode, path_dir=path_dir)
+            self.tsp_solver(0, path_dir=path_dir, timeout=timeout)
+            return self.extract_path(0, path_dir=path_dir)
+        finally:
+            shutil.rmtree(path_dir)
+
     def plot_example(self, x, path, mode='CEIL_2D'):
         MAP, HAM_CYCLE, LENGTH_TOUR = x
         perm = np.array(HAM_CYCLE)
@@ -209,6 +245,118 @@ class TSP(object):
         self.dataset['HAM_CYCLES'] = HAM_CYCLES
         self.dataset['LENGTH_TOURS'] = LENGTH_TOURS
 
+class SolverPool(object):
+    """Runs up to num_solvers LKH processes at once. Every job gets its own
+    scratch directory, at most max_pending jobs are queued and a job that
+    times out or fails is retried up to retries times."""
+    def __init__(self, tsp, num_solvers, timeout=None, retries=2,
+                 max_pending=None):
+        self.tsp = tsp
+        self.timeout = timeout
+        self.retries = retries
+        if max_pending is None:
+            max_pending = 2 * num_solvers
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(num_solvers)
+
+    def solve(self, example, mode='CEIL_2D'):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.tsp.solve(example, mode=mode,
+                                      timeout=self.timeout)
+            except (TimeoutExpired, IOError, ValueError, IndexError) as e:
+                error = e
+                print('LKH attempt {} failed: {}'.format(attempt + 1,
+                                                         repr(e)))
+        raise RuntimeError('LKH failed after {} attempts.'
+                           .format(self.retries + 1)) from error
+
+    def map(self, examples, mode='CEIL_2D'):
+        """Yields (ham_cycle, length_tour) for every example, in order."""
+        futures = collections.deque()
+        for example in examples:
+            if len(futures) == self.max_pending:
+                yield futures.popleft().result()
+            futures.append(self.executor.submit(self.solve, example, mode))
+        while futures:
+            yield futures.popleft().result()
+
+    def close(self):
+        self.executor.shutdown()
+
+class TourCache(object):
+    """Persistent store of solved instances keyed by TSP.instance_key. Each
+    entry is an .npz file with the tour and its length; once there are more
+    than max_entries, the least recently used ones are evicted. The cache
+    can be shared by several processes, so the entries are counted on disk
+    rather than in memory."""
+    def __init__(self, path, max_entries=int(1e6)):
+        self.path = path
+        self.max_entries = max_entries
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def entry_path(self, key):
+        # two levels so that directories stay small
+        return os.path.join(self.path, key[:2], key + '.npz')
+
+    def entries(self):
+        paths = []
+        for subdir in os.listdir(self.path):
+            path_subdir = os.path.join(self.path, subdir)
+            if os.path.isdir(path_subdir):
+                # files being written by put end in .tmp
+                paths.extend(os.path.join(path_subdir, name)
+                             for name in os.listdir(path_subdir)
+                             if name.endswith('.npz'))
+        return paths
+
+    def num_entries(self):
+        return len(self.entries())
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                tour = entry['tour']
+                length = int(entry['length'])
+            # the modification time records the last use
+            os.utime(path)
+        except (IOError, ValueError, KeyError):
+            return None
+        return tour, length
+
+    def put(self, key, tour, length):
+        path = self.entry_path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            return
+        path_tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(path_tmp, 'wb') as file:
+            np.savez(file, tour=tour, length=length)
+        os.replace(path_tmp, path)
+        # other processes may have added entries since the last put
+        if self.num_entries() > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        # evict down to 90% of the cap so eviction runs once in a while
+        paths = self.entries()
+        mtimes = []
+        for path in paths:
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                mtimes.append(0)
+        order = np.argsort(mtimes)
+        num_evicted = len(paths) - int(0.9 * self.max_entries)
+        for i in order[:max(num_evicted, 0)]:
+            try:
+                os.remove(paths[i])
+            except OSError:
+                pass
+
 if __name__ == '__main__':
     path_tsp = '/home/anowak/QAP_pt/src/tsp/LKH/'
     plot_path = '/home/anowak/QAP_pt/plots/tsp.png'
@@ -1,11 +1,13 @@
 import numpy as np
 import os
+import time
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 matplotlib.rcParams.update({'font.size': 22})
 from data_generator import Generator
+from model import fuse_model
 import utils
 
 import torch
@@ -44,6 +46,10 @@ class Logger(object):
         self.cost_test_oracle = []
         self.cost_test_aux = []
         self.cost_test_aux_oracle = []
+        self.local_search_gain = []
+        self.local_search_gain_aux = []
+        self.local_search_time = []
+        self.local_search_time_aux = []
         self.path_examples = None
         self.args = None
 
@@ -77,6 +83,29 @@ class Logger(object):
                              .format(path))
 
 
+    def export_model(self, model, example):
+        """ Saves a TorchScript trace of model, with fused Gconv layers
+        (see fuse_model), for inference. example holds the graph of a sample
+        batch as a [W, x] pair of dense tensors. The InstanceNorm of Gconv
+        depends on the input statistics, so unlike in the QAP model there is
+        no norm to fold. The trace can be run without this code, see
+        inference.load_model. """
+        W, x = example
+        if not torch.is_tensor(W):
+            raise ValueError('Only dense operators can be exported.')
+        model = fuse_model(model)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, ((W, x),))
+        save_dir = os.path.join(self.path, 'parameters/')
+        # Create directory if necessary
+        try:
+            os.stat(save_dir)
+        except:
+            os.mkdir(save_dir)
+        path = os.path.join(save_dir, 'gnn_traced.pt')
+        traced.save(path)
+        print('Model exported to {}.'.format(path))
+
     def plot_example(self, Paths, costs, oracle_costs, Perms,
                      Cities, num_plots=1):
         num_plots = min(num_plots, Paths.size(0))
@@ -132,10 +161,29 @@ class Logger(object):
         self.cost_train.append(sum(costs) / float(len(costs)))
 
     def add_test_accuracy(self, pred, labels, perms, W, cities, oracle_costs,
-                          last=False, beam_size=2):
+                          last=False, beam_size=2, decoder='beam',
+                          num_samples=8, local_search=0, or_opt=False):
         accuracy = utils.compute_accuracy(pred, labels)
-        costs, Paths = utils.beamsearch_hamcycle(pred.data, W.data,
-                                                 beam_size=beam_size)
+        if decoder == 'sample':
+            # best of num_samples tours, W being sqrt(2) minus the distance
+            costs, Paths, _ = utils.sample_hamcycles(pred.data, W.data,
+                                                     num_samples)
+            costs, best = costs.max(1)
+            Paths = Paths[torch.arange(Paths.size(0)), best]
+        elif decoder == 'beam':
+            costs, Paths = utils.beamsearch_hamcycle(pred.data, W.data,
+                                                     beam_size=beam_size)
+        else:
+            raise ValueError('Decoder {} not supported.'.format(decoder))
+        if local_search > 0:
+            start = time.time()
+            Paths, _ = utils.local_search(Paths, W.data, max_iter=local_search,
+                                          or_opt=or_opt)
+            refined = utils.compute_cost_path(Paths, W.data)
+            # the mean tour length saved, at the cost of the elapsed time
+            self.local_search_gain_aux.append((refined - costs).mean().item())
+            self.local_search_time_aux.append(time.time() - start)
+            costs = refined
         self.accuracy_test_aux.append(accuracy)
         self.cost_test_aux.append(np.array(costs.cpu().numpy()).mean())
         self.cost_test_aux_oracle.append(np.array(oracle_costs).mean())
@@ -149,6 +197,13 @@ class Logger(object):
             cost_test_oracle = np.array(self.cost_test_aux_oracle).mean()
             self.cost_test_oracle.append(cost_test_oracle)
             self.cost_test_aux_oracle = []
+            if local_search > 0:
+                self.local_search_gain.append(
+                    np.array(self.local_search_gain_aux).mean())
+                self.local_search_time.append(
+                    np.array(self.local_search_time_aux).sum())
+                self.local_search_gain_aux = []
+                self.local_search_time_aux = []
             self.plot_example(Paths, costs, oracle_costs, perms, cities)
 
     def plot_train_logs(self):
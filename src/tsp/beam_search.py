@@ -36,89 +36,68 @@ else:
 ###############################################################################
 
 class BeamSearch(object):
-    """Ordered beam of candidate outputs."""
-    def __init__(self, beam_size, batch_size, N):
+    """ Batched beam search over Hamiltonian paths starting at node 0.
+    Scores are path log-probabilities under the policy that moves from a
+    node to an unvisited one with probability proportional to the given
+    transition weights; visited nodes are masked with -inf, so hypotheses
+    that run out of unvisited nodes drop out of the beam. Backpointers are
+    kept in preallocated (N, B, K) tensors and all K hypotheses are
+    reconstructed together. """
+    def __init__(self, beam_size, batch_size, N, device=None):
         self.batch_size = batch_size
         self.beam_size = beam_size
         self.N = N
-        self.mask = torch.ones(batch_size, beam_size, N).type(dtype)
-        # mask the starting node of the beam search
-        self.mask[:, :, 0] = 0
-        # The score for each translation on the beam.
-        self.scores = torch.zeros(batch_size, beam_size).type(dtype)
-        self.All_scores = []
-        # The backpointers at each time-step.
-        self.prev_Ks = []
-        # The outputs at each time-step.
-        self.next_nodes = [torch.zeros(batch_size, beam_size).type(dtype_l)]
+        self.step = 0
+        # only the first hypothesis is alive at the start
+        self.scores = torch.full((batch_size, beam_size), -float('inf'),
+                                 device=device)
+        self.scores[:, 0] = 0
+        self.visited = torch.zeros(batch_size, beam_size, N, dtype=torch.bool,
+                                   device=device)
+        self.visited[:, :, 0] = True
+        # node added and beam it extends at every step
+        self.nodes = torch.zeros(N, batch_size, beam_size, dtype=torch.long,
+                                 device=device)
+        self.prev_ks = torch.zeros(N, batch_size, beam_size,
+                                   dtype=torch.long, device=device)
 
-    # Get the outputs for the current timestep.
     def get_current_state(self):
-        """Get state of beam."""
-        current_state =  (self.next_nodes[-1].unsqueeze(2)
-                          .expand(self.batch_size, self.beam_size, self.N))
-        return current_state
+        """ Last node of every hypothesis, of size (B, K). """
+        return self.nodes[self.step]
 
-    # Get the backpointers for the current timestep.
-    def get_current_origin(self):
-        """Get the backpointer to the beam at this step."""
-        return self.prev_Ks[-1]
-
-    def advance(self, trans_probs, it):
-        # prev_probs: probabilites of advancing from the next step
-        """Advance the beam."""
-        # trans_probs has size (bs, K, N)
-        # Sum the previous scores.
-        if len(self.prev_Ks) > 0:
-            beam_lk = (trans_probs + self.scores.unsqueeze(2)
-                       .expand_as(trans_probs))
-        else:
-            beam_lk = trans_probs
-            # only use the first element of the beam (mask to zero the others)
-            beam_lk[:, 1:] = torch.zeros(beam_lk[:, 1:].size()).type(dtype)
-        beam_lk = beam_lk * self.mask
+    def advance(self, weights):
+        """ Extends the beam by one node. weights has size (B, K, N) and
+        holds the non-negative transition weights out of the current node
+        of every hypothesis. """
+        weights = weights.masked_fill(self.visited, 0)
+        logp = (torch.log(weights) -
+                torch.log(weights.sum(2, keepdim=True)))
+        beam_lk = self.scores.unsqueeze(2) + logp
+        beam_lk = beam_lk.masked_fill(self.visited, -float('inf'))
         beam_lk = beam_lk.view(self.batch_size, -1)
-        # beam_lk has size (bs, K*N)
-        bestScores, bestScoresId = beam_lk.topk(self.beam_size, 1, True, True)
-        # bestScores and bestScoresId have size (bs, K)
-        self.scores = bestScores
-        prev_k = bestScoresId / self.N
-        self.prev_Ks.append(prev_k)
-        new_nodes = bestScoresId - prev_k * self.N
-        self.next_nodes.append(new_nodes)
-        # reindex mask
-        perm_mask = prev_k.unsqueeze(2).expand_as(self.mask) # (bs, K, N)
-        self.mask = self.mask.gather(1, perm_mask)
-        # mask new added nodes
-        self.update_mask(new_nodes)
-
-    def update_mask(self, new_nodes):
-        # sets new_nodes to zero in mask
-        arr = (torch.arange(0, self.N).unsqueeze(0).unsqueeze(1)
-               .expand_as(self.mask).type(dtype_l))
-        new_nodes = new_nodes.unsqueeze(2).expand_as(self.mask)
-        # print(arr, new_nodes)
-        update_mask = 1 - torch.eq(arr, new_nodes).type(dtype)
-        self.mask = self.mask*update_mask
-
-    def sort_best(self):
-        """Sort the beam."""
-        return torch.sort(self.scores, 0, True)
-
-    # Get the score of the best in the beam.
-    def get_best(self):
-        """Get the most likely candidate."""
-        scores, ids = self.sort_best()
-        return scores[1], ids[1]
+        # beam_lk has size (B, K*N)
+        scores, ids = beam_lk.topk(self.beam_size, 1, True, True)
+        prev_k = ids // self.N
+        new_nodes = ids % self.N
+        self.scores = scores
+        self.visited = self.visited.gather(
+            1, prev_k.unsqueeze(2).expand_as(self.visited))
+        self.visited.scatter_(2, new_nodes.unsqueeze(2), True)
+        self.step += 1
+        self.prev_ks[self.step] = prev_k
+        self.nodes[self.step] = new_nodes
 
-    def get_hyp(self, k):
-        """ Walk back to construct the full hypothesis.
-        k: the position in the beam to construct."""
-        assert self.N == len(self.prev_Ks) + 1
-        hyp = -1*torch.ones(self.batch_size, self.N).type(dtype_l)
-        # first node always zero
-        hyp[:, 0] = torch.zeros(self.batch_size, 1).type(dtype_l)
-        for j in range(len(self.prev_Ks) - 1, -1, -1):
-            hyp[:, j+1] = self.next_nodes[j + 1].gather(1, k)
-            k = self.prev_Ks[j].gather(1, k)
-        return hyp
\ No newline at end of file
+    def get_hyps(self):
+        """ All K hypotheses, best first, as a (B, K, N) tensor. Dead
+        hypotheses (score -inf, only possible when K exceeds the number of
+        paths) are replaced by the best one. """
+        K = self.beam_size
+        k = torch.arange(K, device=self.scores.device)
+        k = k.unsqueeze(0).expand(self.batch_size, K)
+        k = torch.where(self.scores > -float('inf'), k, torch.zeros_like(k))
+        hyps = torch.zeros(self.batch_size, K, self.step + 1,
+                           dtype=torch.long, device=self.scores.device)
+        for j in range(self.step, 0, -1):
+            hyps[:, :, j] = self.nodes[j].gather(1, k)
+            k = self.prev_ks[j].gather(1, k)
+        return hyps
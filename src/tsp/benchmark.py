@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import numpy as np
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+from model import Siamese_GNN
+from utils import compute_path_probability, compute_tour_costs
+from utils import beamsearch_tours, sample_tours, local_search
+from Logger import Logger
+import inference
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--N', nargs='?', const=1, type=int, default=20)
+parser.add_argument('--J', nargs='?', const=1, type=int, default=4)
+parser.add_argument('--num_features', nargs='?', const=1, type=int,
+                    default=20)
+parser.add_argument('--num_layers', nargs='?', const=1, type=int,
+                    default=20)
+parser.add_argument('--batch_size', nargs='?', const=1, type=int, default=4)
+parser.add_argument('--beam_size', nargs='?', const=1, type=int, default=40)
+
+###############################################################################
+#                            Reference implementations                        #
+###############################################################################
+
+def compute_path_probability_loop(pred, paths):
+    # per path and per edge version used before the batched one
+    pred = F.sigmoid(pred) + 1e-6
+    N = pred.size(-1)
+    Bs = pred.size(0)
+    T = paths.size(1)
+    logp = Variable(torch.zeros(Bs, T))
+    vec1 = torch.zeros(Bs, T)
+    for b in range(Bs):
+        predb = pred[b]
+        for t in range(T):
+            remaining = torch.ones(N)
+            pathbt = paths[b, t]
+            start = pathbt[0]
+            summ = Variable(torch.zeros(1))
+            for end in pathbt[1:]:
+                remaining[start] = 0.0
+                plus = torch.log(predb[start, end] /
+                                 torch.dot(Variable(remaining.clone()),
+                                           predb[start]))
+                summ += plus
+                start = end
+            vec1[b, t] = 1.0
+            logp += Variable(vec1.clone())*summ
+            vec1[b, t] = 0.0
+    return logp
+
+def compute_cost_path_loop(Paths, W):
+    # per node version used before compute_tour_costs, with the closing
+    # edge going back to node 0
+    batch_size = W.size(0)
+    N = W.size(-1)
+    Costs = torch.zeros(batch_size)
+    for b in range(batch_size):
+        path = Paths[b].squeeze(0)
+        Wb = W[b].squeeze(0)
+        cost = 0.0
+        for node in range(N-1):
+            start = path[node]
+            end = path[node + 1]
+            cost += Wb[start, end]
+        cost += Wb[end, 0]
+        Costs[b] = cost
+    return Costs
+
+class BeamSearchReference(object):
+    # decoder used before the log-space BeamSearch, with raw scores
+    # multiplied by a 0/1 mask and one get_hyp call per path
+    def __init__(self, beam_size, batch_size, N):
+        self.batch_size = batch_size
+        self.beam_size = beam_size
+        self.N = N
+        self.mask = torch.ones(batch_size, beam_size, N)
+        # mask the starting node of the beam search
+        self.mask[:, :, 0] = 0
+        # The score for each translation on the beam.
+        self.scores = torch.zeros(batch_size, beam_size)
+        self.All_scores = []
+        # The backpointers at each time-step.
+        self.prev_Ks = []
+        # The outputs at each time-step.
+        self.next_nodes = [torch.zeros(batch_size, beam_size).long()]
+
+    # Get the outputs for the current timestep.
+    def get_current_state(self):
+        """Get state of beam."""
+        current_state =  (self.next_nodes[-1].unsqueeze(2)
+                          .expand(self.batch_size, self.beam_size, self.N))
+        return current_state
+
+    # Get the backpointers for the current timestep.
+    def get_current_origin(self):
+        """Get the backpointer to the beam at this step."""
+        return self.prev_Ks[-1]
+
+    def advance(self, trans_probs, it):
+        # prev_probs: probabilites of advancing from the next step
+        """Advance the beam."""
+        # trans_probs has size (bs, K, N)
+        # Sum the previous scores.
+        if len(self.prev_Ks) > 0:
+            beam_lk = (trans_probs + self.scores.unsqueeze(2)
+                       .expand_as(trans_probs))
+        else:
+            beam_lk = trans_probs
+            # only use the first element of the beam (mask to zero the others)
+            beam_lk[:, 1:] = torch.zeros(beam_lk[:, 1:].size())
+        beam_lk = beam_lk * self.mask
+        beam_lk = beam_lk.view(self.batch_size, -1)
+        # beam_lk has size (bs, K*N)
+        bestScores, bestScoresId = beam_lk.topk(self.beam_size, 1, True, True)
+        # bestScores and bestScoresId have size (bs, K)
+        self.scores = bestScores
+        prev_k = bestScoresId // self.N
+        self.prev_Ks.append(prev_k)
+        new_nodes = bestScoresId - prev_k * self.N
+        self.next_nodes.append(new_nodes)
+        # reindex mask
+        perm_mask = prev_k.unsqueeze(2).expand_as(self.mask) # (bs, K, N)
+        self.mask = self.mask.gather(1, perm_mask)
+        # mask new added nodes
+        self.update_mask(new_nodes)
+
+    def update_mask(self, new_nodes):
+        # sets new_nodes to zero in mask
+        arr = (torch.arange(0, self.N).unsqueeze(0).unsqueeze(1)
+               .expand_as(self.mask).long())
+        new_nodes = new_nodes.unsqueeze(2).expand_as(self.mask)
+        # print(arr, new_nodes)
+        update_mask = (~torch.eq(arr, new_nodes)).float()
+        self.mask = self.mask*update_mask
+
+    def get_hyp(self, k):
+        """ Walk back to construct the full hypothesis.
+        k: the position in the beam to construct."""
+        assert self.N == len(self.prev_Ks) + 1
+        hyp = -1*torch.ones(self.batch_size, self.N).long()
+        # first node always zero
+        hyp[:, 0] = 0
+        for j in range(len(self.prev_Ks) - 1, -1, -1):
+            hyp[:, j+1] = self.next_nodes[j + 1].gather(1, k).squeeze(1)
+            k = self.prev_Ks[j].gather(1, k)
+        return hyp
+
+def beamsearch_paths_loop(pred, n_paths, beam_size):
+    N = pred.size(-1)
+    batch_size = pred.size(0)
+    BS = BeamSearchReference(beam_size, batch_size, N)
+    trans_probs = pred.gather(1, BS.get_current_state())
+    for step in range(N-1):
+        BS.advance(trans_probs, step + 1)
+        trans_probs = pred.gather(1, BS.get_current_state())
+    Paths = torch.zeros(batch_size, n_paths, N).long()
+    for t in range(n_paths):
+        ends = t*torch.ones(batch_size, 1).long()
+        Paths[:, t] = BS.get_hyp(ends)
+    return Paths
+
+def random_paths(batch_size, T, N):
+    # random tours starting at node 0, as returned by the decoders
+    paths = torch.stack([torch.stack([torch.cat((torch.zeros(1).long(),
+                                                 torch.randperm(N - 1) + 1))
+                                      for t in range(T)])
+                         for b in range(batch_size)])
+    return paths
+
+###############################################################################
+#                                  Benchmarks                                 #
+###############################################################################
+
+def benchmark_latency(model, g, num_runs):
+    """ Milliseconds per forward in eval mode. """
+    with torch.no_grad():
+        model(g)
+        if g[0].is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        for i in range(num_runs):
+            model(g)
+        if g[0].is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start) / num_runs * 1000
+
+def benchmark_path_probability(pred, paths, num_runs):
+    """ Milliseconds per forward and backward of the path log-probability,
+    loop vs batched. """
+    results = []
+    for fn in [compute_path_probability_loop, compute_path_probability]:
+        start = time.time()
+        for i in range(num_runs):
+            p = Variable(pred, requires_grad=True)
+            fn(p, paths).sum().backward()
+        results.append((time.time() - start) / num_runs * 1000)
+    return results
+
+def benchmark_tour_costs(paths, W, num_runs):
+    """ Milliseconds to evaluate the (B, T, N) paths, one compute_cost_path
+    call per path vs a single batched gather. """
+    start = time.time()
+    for i in range(num_runs):
+        for t in range(paths.size(1)):
+            compute_cost_path_loop(paths[:, t], W)
+    loop = (time.time() - start) / num_runs * 1000
+    start = time.time()
+    for i in range(num_runs):
+        compute_tour_costs(paths, W)
+    batched = (time.time() - start) / num_runs * 1000
+    return loop, batched
+
+def benchmark_beam_search(pred, beam_size, num_runs):
+    """ Milliseconds to decode all beam_size paths of a batch. """
+    start = time.time()
+    for i in range(num_runs):
+        beamsearch_paths_loop(pred, beam_size, beam_size)
+    loop = (time.time() - start) / num_runs * 1000
+    start = time.time()
+    for i in range(num_runs):
+        beamsearch_tours(pred, beam_size)
+    batched = (time.time() - start) / num_runs * 1000
+    return loop, batched
+
+def benchmark_decoders(pred, beam_size, num_samples, num_runs):
+    """ Milliseconds for the tours and log-probabilities of the training
+    loss, with the beam search and with sampling. """
+    start = time.time()
+    for i in range(num_runs):
+        paths = beamsearch_tours(pred.data, beam_size)
+        compute_path_probability(pred, paths).sum().backward()
+    beam = (time.time() - start) / num_runs * 1000
+    start = time.time()
+    for i in range(num_runs):
+        paths, logp = sample_tours(pred, num_samples)
+        logp.sum().backward()
+    sample = (time.time() - start) / num_runs * 1000
+    return beam, sample
+
+def benchmark_local_search(paths, W, max_iter, or_opt):
+    """ Mean tour length saved by local_search and the seconds it took. """
+    start = time.time()
+    refined, iterations = local_search(paths, W, max_iter, or_opt=or_opt)
+    elapsed = time.time() - start
+    gain = compute_tour_costs(refined.unsqueeze(1), W) - \
+        compute_tour_costs(paths.unsqueeze(1), W)
+    return gain.mean().item(), elapsed
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    cuda = torch.cuda.is_available()
+    print('Inference latency, N {}, {} layers'
+          .format(args.N, args.num_layers + 2))
+    print('{:<10} {:<12} {:<12}'.format('bs', 'eager ms', 'exported ms'))
+    model = Siamese_GNN(args.num_features, args.num_layers, args.N,
+                        args.J + 2, dim_input=3)
+    model.eval()
+    if cuda:
+        model.cuda()
+    path = tempfile.mkdtemp()
+    for bs in [1, 64]:
+        W = torch.rand(bs, args.N, args.N, args.J + 2)
+        x = torch.rand(bs, args.N, 3)
+        if cuda:
+            W, x = W.cuda(), x.cuda()
+        Logger(path).export_model(model, [W, x])
+        exported = inference.load_model(path + '/parameters/gnn_traced.pt',
+                                        cuda=cuda)
+        num_runs = 50 if bs == 1 else 10
+        eager = benchmark_latency(model, (W, x), num_runs)
+        traced = benchmark_latency(exported, (W, x), num_runs)
+        print('{:<10} {:<12.3f} {:<12.3f}'.format(bs, eager, traced))
+    print('\nPath log-probability step, bs {}, beam {}'
+          .format(args.batch_size, args.beam_size))
+    print('{:<10} {:<12} {:<12}'.format('N', 'loop ms', 'batched ms'))
+    for N in [20, 50, 100]:
+        pred = torch.randn(args.batch_size, N, N)
+        paths = random_paths(args.batch_size, args.beam_size, N)
+        loop, batched = benchmark_path_probability(pred, paths, 1)
+        print('{:<10} {:<12.1f} {:<12.1f}'.format(N, loop, batched))
+    print('\nTour costs, bs {}, beam {}'.format(args.batch_size,
+                                                 args.beam_size))
+    print('{:<10} {:<12} {:<12}'.format('N', 'loop ms', 'batched ms'))
+    for N in [20, 50, 100]:
+        W = torch.rand(args.batch_size, N, N)
+        paths = random_paths(args.batch_size, args.beam_size, N)
+        loop, batched = benchmark_tour_costs(paths, W, 1)
+        print('{:<10} {:<12.1f} {:<12.3f}'.format(N, loop, batched))
+    print('\nBeam search, bs {}, beam {}'.format(args.batch_size,
+                                               args.beam_size))
+    print('{:<10} {:<12} {:<12}'.format('N', 'old ms', 'log-space ms'))
+    for N in [20, 50, 100]:
+        pred = torch.randn(args.batch_size, N, N)
+        loop, batched = benchmark_beam_search(pred, args.beam_size, 3)
+        print('{:<10} {:<12.1f} {:<12.1f}'.format(N, loop, batched))
+    print('\nTraining decoders, bs {}, beam {}'.format(args.batch_size,
+                                                   args.beam_size))
+    print('{:<10} {:<12} {:<12} {:<12}'.format('N', 'beam ms', '8 samples',
+                                               '40 samples'))
+    for N in [20, 50, 100]:
+        pred = torch.randn(args.batch_size, N, N, requires_grad=True)
+        beam, sample8 = benchmark_decoders(pred, args.beam_size, 8, 3)
+        _, sample40 = benchmark_decoders(pred, args.beam_size, 40, 3)
+        print('{:<10} {:<12.1f} {:<12.1f} {:<12.1f}'.format(N, beam, sample8,
+                                                           sample40))
+    print('\nLocal search on beam tours, bs {}, beam {}'.format(
+        args.batch_size, args.beam_size))
+    print('{:<10} {:<8} {:<8} {:<12} {:<12}'.format('N', 'or_opt', 'cap',
+                                                    'gain', 'seconds'))
+    for N in [20, 50, 100]:
+        cities = torch.rand(args.batch_size, N, 2)
+        W = np.sqrt(2) - (cities.unsqueeze(2) - cities.unsqueeze(1)).norm(
+            dim=3)
+        paths = beamsearch_tours(torch.randn(args.batch_size, N, N),
+                                 args.beam_size)[:, 0]
+        for or_opt in [False, True]:
+            for cap in [10, 1000]:
+                gain, elapsed = benchmark_local_search(paths, W, cap, or_opt)
+                print('{:<10} {:<8} {:<8} {:<12.3f} {:<12.3f}'.format(
+                    N, str(or_opt), cap, gain, elapsed))
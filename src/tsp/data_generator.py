@@ -6,7 +6,11 @@ import numpy as np
 import os
 # import dependencies
 import time
-from LKH.tsp_solver import TSP
+import copy
+import shutil
+import tempfile
+import multiprocessing
+from LKH.tsp_solver import TSP, SolverPool, TourCache
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -26,6 +30,8 @@ from torch.autograd import Variable
 from torch import optim
 import torch.nn.functional as F
 
+from model import GraphOperators, LineGraphOperators, prepare_operators
+
 if torch.cuda.is_available():
     dtype = torch.cuda.FloatTensor
     dtype_l = torch.cuda.LongTensor
@@ -42,22 +48,45 @@ class Generator(TSP):
         self.path_dataset = path_dataset
         self.num_examples_train = 10e6
         self.num_examples_test = 10e4
-        self.data_train = []
-        self.data_test = []
+        # datasets map every field to an array with one row per example
+        self.data_train = {}
+        self.data_test = {}
         self.dual = False
         self.N = 20
         self.J = 4
         self.mode = mode
         self.sym = True
+        # number of examples whose operators are computed at once
+        self.generation_batch = 100
+        # compute the operators of a generation batch with batched matmuls
+        self.batch_operators = False
+        # dataset seed and number of builder processes
+        self.seed = 0
+        self.num_workers = 1
+        # number of concurrent LKH processes per builder process
+        self.num_solvers = 1
+        self.solver_timeout = None
+        self.solver_pool = None
+        # persistent cache of LKH tours, see LKH.tsp_solver.TourCache
+        self.tour_cache = None
+        # feed the model only the powers and degrees of the operators
+        self.structured_operators = False
+        # operators of the line graph, shared by all examples in dual mode
+        self.line_graph = None
+        # pinned host buffers reused to stage batches, see to_torch
+        self.buffers = {}
 
     def ErdosRenyi(self, p, N):
-        W = np.zeros((N, N))
-        for i in range(0, N - 1):
-            for j in range(i + 1, N):
-                add_edge = (np.random.uniform(0, 1) < p)
-                if add_edge:
-                    W[i, j] = 1
-                W[j, i] = W[i, j]
+        return self.ErdosRenyi_batch(p, N, 1)[0]
+
+    def ErdosRenyi_batch(self, p, N, B):
+        """ Generate B Erdos-Renyi graphs as a (B, N, N) symmetric array.
+        p can be a scalar or an array with one edge probability per graph."""
+        p = np.reshape(p, [-1, 1, 1])
+        upper = np.triu(np.ones((N, N), dtype=bool), k=1)
+        W = (np.random.uniform(0, 1, [B, N, N]) < p) & upper
+        W = W.astype(float)
+        W += W.transpose(0, 2, 1)
         return W
 
     def compute_operators(self, W):
@@ -79,35 +108,67 @@ class Generator(TSP):
         x = np.reshape(d, [N, 1])
         return WW, x
 
+    def compute_operators_batch(self, W, WW=None):
+        """ Batched version of compute_operators. W has size (B, N, N) and
+        the operators are written to WW, a (B, N, N, J+2) array that is
+        allocated if not given. x has size (B, N, 1)."""
+        B, N = W.shape[0], W.shape[1]
+        if WW is None:
+            WW = np.empty([B, N, N, self.J + 2])
+        diag = np.arange(N)
+        WW[:, :, :, 0] = 0
+        WW[:, diag, diag, 0] = 1
+        # channel J holds D, so only the powers stored in channels 1..J-1
+        # are computed
+        buffers = [np.empty([B, N, N]), np.empty([B, N, N])]
+        QQ = W
+        for j in range(self.J - 1):
+            WW[:, :, :, j + 1] = QQ
+            if j < self.J - 2:
+                QQ = np.matmul(QQ, QQ, out=buffers[j % 2])
+                QQ /= QQ.max(axis=(1, 2), keepdims=True)
+                QQ *= np.sqrt(2)
+        d = W.sum(2)
+        WW[:, :, :, self.J] = 0
+        WW[:, diag, diag, self.J] = d
+        WW[:, :, :, self.J + 1] = 1.0 / float(N)
+        x = np.reshape(d, [B, N, 1])
+        return WW, x
+
+    def structure_operators(self, WW):
+        """ Splits a (..., N, N, J+2) operator stack into the powers of
+        channels 1..J-1 and the degree vector on the diagonal of channel J.
+        The identity and the mean operator need not be stored, the model
+        applies them in closed form (see GraphOperators). """
+        powers = np.ascontiguousarray(WW[..., 1:self.J])
+        degrees = np.diagonal(WW[..., self.J], axis1=-2, axis2=-1).copy()
+        return powers, degrees
+
+    def edge_weights(self, cities):
+        """ sqrt(2) minus the CEIL_2D distance between every pair of cities,
+        with cities of size (..., N, 2). The diagonal is zero. """
+        cities = cities*self.C
+        diff = cities[..., :, np.newaxis, :] - cities[..., np.newaxis, :, :]
+        dist = np.ceil(np.sqrt(np.square(diff).sum(-1)))/float(self.C)
+        W = np.sqrt(2) - dist
+        N = cities.shape[-2]
+        W[..., np.arange(N), np.arange(N)] = 0
+        return W
+
     def adj_from_coord(self, cities):
-        N = cities.shape[0]
+        N = cities.shape[-2]
         if self.dual:
-            E =  int(N*(N-1)/2)
-            Edges = []
-            W = np.zeros((E, E))
-            for i in range(0, N-1):
-                for j in range(i+1,N):
-                    Edges.append([i, j])
-            assert len(Edges) == E
-            Edges = np.array(Edges)
-            for i in range(E):
-                W[i] = ((Edges[i,0] == Edges) + (Edges[i,1] == Edges)).sum(1)
-            # zero diagonal
-            for i in range(E):
-                W[i, i] = 0
+            # line graph: edges (i, j) are adjacent when they share a city,
+            # i.e. B^T B - 2I with B the N x E incidence matrix
+            E = int(N*(N-1)/2)
+            rows, cols = np.triu_indices(N, k=1)
+            B = np.zeros((N, E))
+            B[rows, np.arange(E)] = 1
+            B[cols, np.arange(E)] = 1
+            W = np.dot(B.T, B)
+            W[np.arange(E), np.arange(E)] = 0
         else:
-            W = np.zeros((N, N))
-            def l2_dist(x, y):
-                return math.ceil(np.sqrt(np.square(x - y).sum()))
-            def l1_dist(x, y):
-                return np.abs(x - y).sum()
-            for i in range(0, N - 1):
-                for j in range(i + 1, N):
-                    city1 = cities[i]*self.C
-                    city2 = cities[j]*self.C
-                    dist = l2_dist(city1, city2)/float(self.C)
-                    W[i, j] = np.sqrt(2) - float(dist)
-                    W[j, i] = W[i, j]
+            W = self.edge_weights(cities)
         return W
 
     def cycle_adj(self, N, sym=False):
@@ -131,173 +192,307 @@ class Generator(TSP):
         return W
 
     def create_dual_embeddings(self, cities):
-        def l2_dist(x, y):
-            return math.ceil(np.sqrt(np.square(x - y).sum()))
-        def l1_dist(x, y):
-            return np.abs(x - y).sum()
-        x = []
-        for i in range(0, self.N-1):
-            for j in range(i+1, self.N):
-                city1 = cities[i]*self.C
-                city2 = cities[j]*self.C
-                dist = l2_dist(city1, city2)/float(self.C)
-                dist = np.sqrt(2) - float(dist)
-                x.append(dist)
-        x = np.reshape(np.array(x), [-1,1])
-        return x
+        # edge weights of the (i, j), i < j, edges in row-major order, as
+        # an (..., E, 1) array
+        rows, cols = np.triu_indices(cities.shape[-2], k=1)
+        x = self.edge_weights(cities)[..., rows, cols]
+        return x[..., np.newaxis]
 
     def create_adj(self, Cities):
-        cities = Cities.cpu().numpy()
-        N = cities.shape[1]
-        batch_size = cities.shape[0]
-        W = np.zeros((batch_size, N, N))
-        def l2_dist(x, y):
-            return math.ceil(np.sqrt(np.square(x - y).sum()))
-        def l1_dist(x, y):
-            return np.abs(x - y).sum()
-        for b in range(batch_size):
-            for i in range(0, N - 1):
-                for j in range(i + 1, N):
-                    city1 = cities[b, i]*self.C
-                    city2 = cities[b, j]*self.C
-                    dist = l2_dist(city1, city2)/float(self.C)
-                    W[b, i, j] = np.sqrt(2) - float(dist)
-                    W[b, j, i] = W[b, i, j]
+        W = self.edge_weights(Cities.cpu().numpy())
         W = torch.from_numpy(W).type(dtype)
         return W
 
     def compute_example(self, i):
-        example = {}
-        if self.mode == 'CEIL_2D':
-            cities = self.cities_generator(self.N)
-            if i == 0 and self.dual:
+        example = self.compute_examples(1)[0]
+        features = self.compute_features(example['cities'][np.newaxis],
+                                         example['perm'][np.newaxis])
+        for field in features:
+            example[field] = features[field][0]
+        return example
+
+    def compute_examples(self, B):
+        """ Raw examples: the cities and their LKH tour. Everything else is
+        derived from them by compute_features. """
+        if self.mode != 'CEIL_2D':
+            raise ValueError('Mode {} not supported.'.format(self.mode))
+        cities = [self.cities_generator(self.N) for b in range(B)]
+        examples = []
+        # compute hamiltonian cycles
+        for b, tour in enumerate(self.solve_tours(cities)):
+            example = {}
+            example['cities'] = cities[b]
+            self.add_tour(example, *tour)
+            examples.append(example)
+        return examples
+
+    def add_tour(self, example, ham_cycle, length_cycle):
+        cost = float(length_cycle)/float(self.C)
+        example['Length_cycle'] = np.sqrt(2)*self.N - cost
+        example['perm'] = ham_cycle
+        return example
+
+    def compute_features(self, cities, perms):
+        """ Operators, node embeddings and tour labels of a batch of raw
+        examples, with cities of size (B, N, 2) and perms of size (B, N).
+        They depend on J, dual and sym, so they are recomputed rather than
+        saved with the dataset. """
+        B = cities.shape[0]
+        features = {}
+        if self.dual:
+            # the line graph does not depend on the cities, its operators
+            # are applied implicitly, see line_graph_operators
+            features['x'] = self.create_dual_embeddings(cities)
+        else:
+            if self.batch_operators:
                 W = self.adj_from_coord(cities)
-                WW, x = self.compute_operators(W)
-                example['WW'] = WW
+                WW, x = self.compute_operators_batch(W)
             else:
-                W = self.adj_from_coord(cities)
-                WW, x = self.compute_operators(W)
-                example['WW'] = WW
+                WW, x = zip(*[self.compute_operators(self.adj_from_coord(c))
+                              for c in cities])
+                WW, x = np.stack(WW), np.stack(x)
             # add_coordinates
-            if self.dual:
-                x = self.create_dual_embeddings(cities)
+            features['x'] = np.concatenate([x, cities], axis=2)
+            if self.structured_operators:
+                features['powers'], features['degrees'] = (
+                    self.structure_operators(WW))
             else:
-                x = np.concatenate([x, cities], axis=1)
-            example['cities'] = cities
-            example['x'] = x
-            # compute hamiltonian cycle
-            self.save_solverformat(cities, self.N, mode='CEIL_2D')
-        elif self.mode == 'EXPLICIT':
-            W = self.adj_generator(self.N)
-            WW, x = self.compute_operators(W)
-            example['WW'], example['x'] = WW, x
-            # compute hamiltonian cycle
-            self.save_solverformat(W, self.N, mode='EXPLICIT')
-            raise ValueError('Mode {} not yet supported.'.format(mode))
+                features['WW'] = WW
+        features['WTSP'] = np.stack([self.perm_to_adj(perm, self.N)
+                                     for perm in perms])
+        features['labels'] = np.stack([self.perm_to_labels(perm, self.N,
+                                                           sym=self.sym)
+                                       for perm in perms])
+        return features
+
+    def solve_tours(self, cities):
+        """ Returns (ham_cycle, length_cycle) for every set of cities. Tours
+        in the cache are reused, the others are solved by LKH. """
+        tours = [None] * len(cities)
+        if self.tour_cache is not None:
+            keys = [self.instance_key(c, mode='CEIL_2D') for c in cities]
+            tours = [self.tour_cache.get(key) for key in keys]
+        missing = [b for b in range(len(cities)) if tours[b] is None]
+        if self.num_solvers > 1:
+            if self.solver_pool is None:
+                self.solver_pool = SolverPool(self, self.num_solvers,
+                                              timeout=self.solver_timeout)
+            solved = self.solver_pool.map([cities[b] for b in missing],
+                                          mode='CEIL_2D')
         else:
-            raise ValueError('Mode {} not supported.'.format(mode))
-        self.tsp_solver(self.N)
-        # print(cities)
-        ham_cycle, length_cycle = self.extract_path(self.N)
-        example['HAM_cycle'] = ham_cycle
-        cost = float(length_cycle)/float(self.C)
-        example['Length_cycle'] = np.sqrt(2)*self.N - cost
-        example['WTSP'] = self.perm_to_adj(ham_cycle, self.N)
-        example['labels'] = self.perm_to_labels(ham_cycle, self.N,
-                                                sym=self.sym)
-        example['perm'] = ham_cycle
-        return example
+            def solve_serial():
+                for b in missing:
+                    self.save_solverformat(cities[b], self.N, mode='CEIL_2D')
+                    self.tsp_solver(self.N, timeout=self.solver_timeout)
+                    yield self.extract_path(self.N)
+            solved = solve_serial()
+        for b, tour in zip(missing, solved):
+            tours[b] = tour
+            if self.tour_cache is not None:
+                self.tour_cache.put(keys[b], *tour)
+        return tours
+
+    def compute_shard(self, split, shard, num_examples):
+        # every shard has its own seed, so a dataset only depends on the seed
+        # and not on the number of workers the shards are spread across
+        seed = np.random.SeedSequence([self.seed, split, shard])
+        seed = int(seed.generate_state(1)[0])
+        # the global generators are restored afterwards, so that sampling
+        # after building a dataset does not depend on the last shard
+        np_state, state = np.random.get_state(), random.getstate()
+        np.random.seed(seed)
+        random.seed(seed)
+        try:
+            return self.compute_examples(num_examples)
+        finally:
+            np.random.set_state(np_state)
+            random.setstate(state)
+
+    def create_dataset(self, num_examples, split, name, path=None):
+        shards = []
+        for i in range(0, num_examples, self.generation_batch):
+            B = min(self.generation_batch, num_examples - i)
+            shards.append((split, len(shards), B))
+        if self.num_workers > 1:
+            # workers get a copy of the generator without the datasets and
+            # write their LKH files to their own directory
+            gen = copy.copy(self)
+            gen.data_train, gen.data_test = {}, {}
+            gen.solver_pool = None
+            gen.buffers = {}
+            path_scratch = tempfile.mkdtemp(prefix='lkh')
+            pool = multiprocessing.Pool(self.num_workers,
+                                        initializer=init_worker,
+                                        initargs=(gen, path_scratch))
+            examples_shards = pool.imap(compute_shard, shards)
+        else:
+            examples_shards = (self.compute_shard(*shard) for shard in shards)
+        def log_progress(examples_shards):
+            num_computed = 0
+            for examples in examples_shards:
+                num_computed += len(examples)
+                print('{} examples {} to {} of length {} computed.'
+                      .format(name, num_computed - len(examples),
+                              num_computed - 1, self.N))
+                yield examples
+        examples_shards = log_progress(examples_shards)
+        if path is None:
+            examples = [e for examples in examples_shards for e in examples]
+            data = stack_examples(examples)
+        else:
+            data = self.write_dataset(path, examples_shards, num_examples)
+        if self.num_workers > 1:
+            pool.close()
+            pool.join()
+            shutil.rmtree(path_scratch)
+        if self.solver_pool is not None:
+            self.solver_pool.close()
+            self.solver_pool = None
+        return data
 
-    def create_dataset_train(self):
-        for i in range(self.num_examples_train):
-            example = self.compute_example(i)
-            self.data_train.append(example)
-            if i % 100 == 0:
-                print('Train example {} of length {} computed.'
-                      .format(i, self.N))
-
-    def create_dataset_test(self):
-        for i in range(self.num_examples_test):
-            example = self.compute_example(i)
-            self.data_test.append(example)
-            if i % 100 == 0:
-                print('Test example {} of length {} computed.'
-                      .format(i, self.N))
+    def write_dataset(self, path, examples_shards, num_examples):
+        """ Writes the dataset as one .npy file per field, filled shard by
+        shard, and returns it opened as memory maps. """
+        path_tmp = path + '.tmp'
+        if os.path.exists(path_tmp):
+            shutil.rmtree(path_tmp)
+        os.makedirs(path_tmp)
+        columns = {}
+        i = 0
+        for examples in examples_shards:
+            rows = stack_examples(examples)
+            for field in rows:
+                if field not in columns:
+                    path_field = os.path.join(path_tmp, field + '.npy')
+                    shape = (num_examples,) + rows[field].shape[1:]
+                    columns[field] = np.lib.format.open_memmap(
+                        path_field, mode='w+', dtype=rows[field].dtype,
+                        shape=shape)
+                columns[field][i:i + len(examples)] = rows[field]
+            i += len(examples)
+        for column in columns.values():
+            column.flush()
+        del columns
+        # only complete datasets get the final name
+        os.rename(path_tmp, path)
+        return self.read_dataset(path)
+
+    def read_dataset(self, path):
+        dataset = {}
+        for filename in sorted(os.listdir(path)):
+            field = os.path.splitext(filename)[0]
+            dataset[field] = np.load(os.path.join(path, filename),
+                                     mmap_mode='r')
+        return dataset
+
+    def create_dataset_train(self, path=None):
+        self.data_train = self.create_dataset(self.num_examples_train, 0,
+                                              'Train', path=path)
+
+    def create_dataset_test(self, path=None):
+        self.data_test = self.create_dataset(self.num_examples_test, 1,
+                                             'Test', path=path)
 
     def load_dataset(self):
+        # the datasets only hold raw examples, see compute_features. They
+        # are directories with one memory mapped .npy per field.
         # load train dataset
-        filename = 'TSP{}{}train_dual_{}.np'.format(self.N, self.mode,
-                                                    self.dual)
+        filename = 'TSP{}{}train_raw'.format(self.N, self.mode)
         path = os.path.join(self.path_dataset, filename)
         if os.path.exists(path):
             print('Reading training dataset at {}'.format(path))
-            self.data_train = np.load(open(path, 'rb'))
+            self.data_train = self.read_dataset(path)
         else:
             print('Creating training dataset.')
-            self.create_dataset_train()
             print('Saving training datatset at {}'.format(path))
-            np.save(open(path, 'wb'), self.data_train)
+            self.create_dataset_train(path=path)
         # load test dataset
-        filename = 'TSP{}{}test_dual_{}.np'.format(self.N, self.mode,
-                                                   self.dual)
+        filename = 'TSP{}{}test_raw'.format(self.N, self.mode)
         path = os.path.join(self.path_dataset, filename)
         if os.path.exists(path):
             print('Reading testing dataset at {}'.format(path))
-            self.data_test = np.load(open(path, 'rb'))
+            self.data_test = self.read_dataset(path)
         else:
             print('Creating testing dataset.')
-            self.create_dataset_test()
             print('Saving testing datatset at {}'.format(path))
-            np.save(open(path, 'wb'), self.data_test)
+            self.create_dataset_test(path=path)
+
+    def to_torch(self, name, array, cuda):
+        """ Converts a batch to a float tensor. With cuda the batch is staged
+        in a pinned buffer kept under name and copied to the GPU without
+        blocking; the buffer is reused once that copy has finished. """
+        if not cuda:
+            return torch.from_numpy(np.asarray(array, dtype=np.float32))
+        buffer, copied = self.buffers.get(name, (None, None))
+        if buffer is None or tuple(buffer.size()) != array.shape:
+            buffer = torch.empty(array.shape, pin_memory=True)
+        else:
+            copied.synchronize()
+        buffer.numpy()[...] = array
+        tensor = buffer.cuda(non_blocking=True)
+        copied = torch.cuda.Event()
+        copied.record()
+        self.buffers[name] = (buffer, copied)
+        return tensor
+
+    def line_graph_operators(self, cuda):
+        if self.line_graph is None:
+            self.line_graph = LineGraphOperators(self.N, self.J)
+            if cuda:
+                self.line_graph = self.line_graph.cuda()
+        return self.line_graph
 
     def sample_batch(self, num_samples, is_training=True, it=0,
                      cuda=True, volatile=False):
-        WW_size = self.data_train[0]['WW'].shape
-        x_size = self.data_train[0]['x'].shape
-
-        # define batch elements
-        WW = torch.zeros(num_samples, *WW_size)
-        X = torch.zeros(num_samples, *x_size)
-        WTSP = torch.zeros(num_samples, self.N, self.N)
-        if self.sym:
-            P = torch.zeros(num_samples, self.N, 2)
-        else:
-            P = torch.zeros(num_samples, self.N)
-        Cities = torch.zeros((num_samples, self.N, 2))
-        Perm = torch.zeros((num_samples, self.N))
-        Cost = np.zeros(num_samples)
-        # fill batch elements 
         if is_training:
             dataset = self.data_train
+            # random elements in the dataset
+            inds = np.random.randint(0, dataset['perm'].shape[0], num_samples)
         else:
             dataset = self.data_test
-        for b in range(num_samples):
-            if is_training:
-                # random element in the dataset
-                ind = np.random.randint(0, len(dataset))
-            else:
-                ind = it * num_samples + b
-            if self.dual:
-                ww = torch.from_numpy(dataset[0]['WW'])
-            else:
-                ww = torch.from_numpy(dataset[ind]['WW'])
-            x = torch.from_numpy(dataset[ind]['x'])
-            WW[b], X[b] = ww, x
-            WTSP[b] = torch.from_numpy(dataset[ind]['WTSP'])
-            P[b] = torch.from_numpy(dataset[ind]['labels'])
-            Cities[b] = torch.from_numpy(dataset[ind]['cities'])
-            Perm[b] = torch.from_numpy(dataset[ind]['perm'])
-            Cost[b] = dataset[ind]['Length_cycle']
+            inds = it * num_samples + np.arange(num_samples)
+        # read the sampled rows and compute their features
+        cities = dataset['cities'][inds]
+        perms = dataset['perm'][inds]
+        features = self.compute_features(cities, perms)
+        if self.dual:
+            WW = self.line_graph_operators(cuda)
+        elif self.structured_operators:
+            powers = self.to_torch('powers', features['powers'], cuda)
+            degrees = self.to_torch('degrees', features['degrees'], cuda)
+            WW = GraphOperators(prepare_operators(powers), degrees)
+        else:
+            WW = Variable(self.to_torch('WW', features['WW'], cuda),
+                          volatile=volatile)
+        X = self.to_torch('x', features['x'], cuda)
+        WTSP = self.to_torch('WTSP', features['WTSP'], cuda)
+        P = self.to_torch('labels', features['labels'], cuda)
+        Cities = self.to_torch('cities', cities, cuda)
+        Perm = self.to_torch('perm', perms, cuda)
+        Cost = np.array(dataset['Length_cycle'][inds])
         # wrap as variables
-        WW = Variable(WW, volatile=volatile)
         X = Variable(X, volatile=volatile)
         WTSP = Variable(WTSP, volatile=volatile)
         P = Variable(P, volatile=volatile)
-        if cuda:
-            return ([WW.cuda(), X.cuda()], [WTSP.cuda(), P.cuda()],
-                    Cities.cuda(), Perm.cuda(), Cost)
-        else:
-            return [WW, X], [WTSP, P], Cities, Perm, Cost
+        return [WW, X], [WTSP, P], Cities, Perm, Cost
+
+###############################################################################
+#                           Dataset builder helpers                           #
+###############################################################################
+
+def stack_examples(examples):
+    # list of examples -> dictionary of (num_examples, ...) arrays
+    return {field: np.stack([example[field] for example in examples])
+            for field in examples[0]}
+
+def init_worker(gen, path_scratch):
+    global worker_gen
+    worker_gen = gen
+    worker_gen.path_datatsp = os.path.join(path_scratch, str(os.getpid()))
+    os.mkdir(worker_gen.path_datatsp)
+
+def compute_shard(shard):
+    return worker_gen.compute_shard(*shard)
 
 if __name__ == '__main__':
     # Test Generator module
@@ -0,0 +1,25 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+# Runs models exported with Logger.export_model. Only torch is needed, the
+# traced graph does not depend on the training code.
+
+import torch
+
+
+def load_model(path, cuda=False):
+    device = 'cuda' if cuda else 'cpu'
+    return torch.jit.load(path, map_location=device)
+
+def score_edges(model, g):
+    # g is a (W, x) pair of dense tensors, the output has size (bs, N, N)
+    with torch.no_grad():
+        return model(tuple(g))
+
+if __name__ == '__main__':
+    import sys
+    model = load_model(sys.argv[1])
+    bs, N, J = 1, 20, 6
+    W = torch.rand(bs, N, N, J)
+    x = torch.rand(bs, N, 3)
+    print(score_edges(model, (W, x)).size())
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+import copy
+import queue
+import threading
+
+
+class Prefetcher(object):
+    """ Assembles training batches of a Generator in a background thread and
+    keeps up to depth of them ready in a bounded queue, so that sampling the
+    next batch overlaps with the model step on the current one. """
+    def __init__(self, gen, batch_size, depth=2, cuda=True):
+        # the producer gets its own staging buffers so that batches sampled
+        # from the main thread (e.g. for testing) never share them
+        self.gen = copy.copy(gen)
+        self.gen.buffers = {}
+        self.batch_size = batch_size
+        self.cuda = cuda
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        try:
+            while not self.stopped.is_set():
+                self.put(self.gen.sample_batch(self.batch_size,
+                                               cuda=self.cuda))
+        except Exception as error:
+            # handed over to the consumer, which raises it on next()
+            self.put(error)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next(self):
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        return self
+
+    __next__ = next
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
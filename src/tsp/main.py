@@ -5,9 +5,12 @@ import numpy as np
 import os
 # import dependencies
 from data_generator import Generator
-from model import Siamese_GNN, Siamese_2GNN
+from loader import Prefetcher
+from LKH.tsp_solver import TourCache
+from model import Siamese_GNN, Siamese_2GNN, GraphOperators
 from Logger import Logger
-from utils import beamsearch_hamcycles
+from utils import beamsearch_hamcycles, compute_path_probability
+from utils import sample_hamcycles
 import time
 import matplotlib
 matplotlib.use('Agg')
@@ -39,10 +42,29 @@ parser.add_argument('--num_examples_train', nargs='?', const=1, type=int,
                     default=int(20000))
 parser.add_argument('--num_examples_test', nargs='?', const=1, type=int,
                     default=int(1000))
+parser.add_argument('--batch_operators', action='store_true')
+parser.add_argument('--generation_batch', nargs='?', const=1, type=int,
+                    default=100)
+parser.add_argument('--num_workers', nargs='?', const=1, type=int, default=1)
+parser.add_argument('--dataset_seed', nargs='?', const=1, type=int, default=0)
+parser.add_argument('--num_solvers', nargs='?', const=1, type=int, default=1)
+parser.add_argument('--solver_timeout', nargs='?', const=1, type=float,
+                    default=None)
+parser.add_argument('--path_cache', nargs='?', const=1, type=str, default='')
+parser.add_argument('--cache_size', nargs='?', const=1, type=int,
+                    default=int(1e6))
+parser.add_argument('--structured_operators', action='store_true')
+parser.add_argument('--export', action='store_true')
+parser.add_argument('--prefetch', nargs='?', const=1, type=int, default=0)
 parser.add_argument('--iterations', nargs='?', const=1, type=int,
                     default=int(10e6))
 parser.add_argument('--batch_size', nargs='?', const=1, type=int, default=1)
 parser.add_argument('--beam_size', nargs='?', const=1, type=int, default=2)
+parser.add_argument('--decoder', nargs='?', const=1, type=str, default='beam',
+                    choices=['beam', 'sample'])
+parser.add_argument('--num_samples', nargs='?', const=1, type=int, default=8)
+parser.add_argument('--local_search', nargs='?', const=1, type=int, default=0)
+parser.add_argument('--or_opt', action='store_true')
 parser.add_argument('--mode', nargs='?', const=1, type=str, default='train')
 parser.add_argument('--path_dataset', nargs='?', const=1, type=str, default='')
 parser.add_argument('--path_load', nargs='?', const=1, type=str, default='')
@@ -60,6 +82,8 @@ parser.add_argument('--clip_grad_norm', nargs='?', const=1, type=float,
 
 parser.add_argument('--num_features', nargs='?', const=1, type=int,
                     default=50)
+parser.add_argument('--two_tower', action='store_true')
+parser.add_argument('--dual_sym', action='store_true')
 parser.add_argument('--num_layers', nargs='?', const=1, type=int,
                     default=20)
 parser.add_argument('--J', nargs='?', const=1, type=int, default=4)
@@ -91,9 +115,11 @@ info_test = ['TEST', 'iteration', 'loss', 'accuracy', 'cost',
 cross_entropy = True
 
 def extract(sample):
-    input = sample[0], sample[0]
+    input = sample[0]
     if args.dual:
         W = Variable(gen.create_adj(sample[2]))
+    elif isinstance(sample[0][0], GraphOperators):
+        W = sample[0][0].adjacency()
     else:
         W = sample[0][0][:, :, :, 1]
     WTSP, labels = sample[1][0].type(dtype_l), sample[1][1].type(dtype_l)
@@ -117,30 +143,6 @@ def compute_loss(pred, target):
         # raise ValueError('Only cross entropy implemented.')
     return loss
 
-def compute_path_probability(pred, paths):
-    pred = F.sigmoid(pred) + 1e-6
-    N = pred.size(-1)
-    Bs = pred.size(0)
-    T = paths.size(1)
-    logp = Variable(torch.zeros(Bs,T).type(dtype))
-    vec1 = torch.zeros(Bs,T).type(dtype)
-    for b in range(Bs):
-        predb = pred[b]
-        for t in range(T):
-            remaining = torch.ones(N).type(dtype)
-            pathbt = paths[b,t]
-            start = pathbt[0]
-            summ = Variable(torch.zeros(1).type(dtype))
-            for end in pathbt[1:]:
-                remaining[start] = 0.0
-                plus = torch.log(predb[start,end] / torch.dot(Variable(remaining), predb[start]))
-                summ += plus
-                start = end
-            vec1[b,t] = 1.0
-            logp += Variable(vec1)*summ
-            vec1[b,t] = 0.0
-    return logp
-
 #def compute_path_matrix(N, path):
     
 
@@ -154,9 +156,15 @@ def compute_path_probability_relaxed(pred, paths):
     #prob = torch.sum(torch.mm(I.index_select(1,torch.cat((pathbt[1:],torch.LongTensor([pathbt[0]])),0)),I.index_select(0,pathbt)) * predb)
 
 def compute_loss2(pred, W):
-    costs,paths = beamsearch_hamcycles(pred.data, W.data, 3, beam_size=args.beam_size)
+    if args.decoder == 'sample':
+        # tours drawn from the policy, with their log-probabilities
+        costs, paths, probs = sample_hamcycles(pred, W.data, args.num_samples)
+    elif args.decoder == 'beam':
+        costs,paths = beamsearch_hamcycles(pred.data, W.data, 3, beam_size=args.beam_size)
+        probs = compute_path_probability(pred, paths)
+    else:
+        raise ValueError('Decoder {} not supported.'.format(args.decoder))
     costs = Variable(costs)
-    probs = compute_path_probability(pred, paths)
     #print(probs)
     Bs = pred.size(0)
     T = probs.size(1)
@@ -165,12 +173,20 @@ def compute_loss2(pred, W):
 
 def train(siamese_gnn, logger, gen):
     optimizer = torch.optim.Adamax(siamese_gnn.parameters(), lr=1e-3)
+    loader = None
+    if args.prefetch > 0:
+        loader = Prefetcher(gen, batch_size, depth=args.prefetch,
+                            cuda=torch.cuda.is_available())
     for it in range(args.iterations):
         # siamese_gnn.train()
         start = time.time()
-        sample = gen.sample_batch(batch_size, cuda=torch.cuda.is_available())
+        if loader is not None:
+            sample = loader.next()
+        else:
+            sample = gen.sample_batch(batch_size,
+                                      cuda=torch.cuda.is_available())
         input, W, WTSP, labels, target, cities, perms, costs = extract(sample)
-        pred = siamese_gnn(*input)
+        pred = siamese_gnn(input)
         #print(W, WTSP, labels, target, cities, perms, costs)
         loss = compute_loss2(pred, W)
         #print("loss",loss)
@@ -194,6 +210,8 @@ def train(siamese_gnn, logger, gen):
             #logger.plot_test_logs()
         if it % logger.args['save_freq'] == logger.args['save_freq'] - 1:
             logger.save_model(siamese_gnn)
+    if loader is not None:
+        loader.close()
     print('Optimization finished.')
 
 def test(siamese_gnn, logger, gen):
@@ -204,11 +222,15 @@ def test(siamese_gnn, logger, gen):
         batch = gen.sample_batch(batch_size, is_training=False, it=it,
                                  cuda=torch.cuda.is_available())
         input, W, WTSP, labels, target, cities, perms, costs = extract(batch)
-        pred = siamese_gnn(*input)
+        pred = siamese_gnn(input)
         loss = compute_loss2(pred, W)
         last = (it == iterations_test-1)
         logger.add_test_accuracy(pred, labels, perms, W, cities, costs,
-                                 last=last, beam_size=args.beam_size)
+                                 last=last, beam_size=args.beam_size,
+                                 decoder=args.decoder,
+                                 num_samples=args.num_samples,
+                                 local_search=args.local_search,
+                                 or_opt=args.or_opt)
         logger.add_test_loss(loss, last=last)
         elapsed = time.time() - start
         if not last and it % 100 == 0:
@@ -219,22 +241,43 @@ def test(siamese_gnn, logger, gen):
             print(template_test2.format(*out))
     print('TEST COST: {} | TEST ACCURACY {}\n'
           .format(logger.cost_test[-1], logger.accuracy_test[-1]))
+    if args.local_search > 0:
+        print('LOCAL SEARCH GAIN: {} | LOCAL SEARCH TIME {}\n'
+              .format(logger.local_search_gain[-1],
+                      logger.local_search_time[-1]))
 
 if __name__ == '__main__':
+    if args.two_tower and args.dual:
+        # the towers score node embeddings, dual mode embeds the edges
+        raise ValueError('--two_tower is not supported with --dual.')
     logger = Logger(args.path_logger)
     logger.write_settings(args)
     gen = Generator(args.path_dataset, args.path_tsp)
     # generator setup
     gen.num_examples_train = args.num_examples_train
     gen.num_examples_test = args.num_examples_test
+    gen.batch_operators = args.batch_operators
+    gen.generation_batch = args.generation_batch
+    gen.num_workers = args.num_workers
+    gen.seed = args.dataset_seed
+    gen.num_solvers = args.num_solvers
+    gen.solver_timeout = args.solver_timeout
+    if args.path_cache != '':
+        gen.tour_cache = TourCache(args.path_cache, args.cache_size)
+    gen.structured_operators = args.structured_operators
     gen.J = args.J
     gen.N = args.N
     gen.dual = args.dual
     # load dataset
     gen.load_dataset()
     # initialize model
-    siamese_gnn = Siamese_GNN(args.num_features, args.num_layers, gen.N,
-                              args.J + 2, dim_input=3, dual=args.dual)
+    if args.two_tower:
+        siamese_gnn = Siamese_2GNN(args.num_features, args.num_layers,
+                                   args.J + 2, dim_input=3)
+    else:
+        siamese_gnn = Siamese_GNN(args.num_features, args.num_layers, gen.N,
+                                  args.J + 2, dim_input=3, dual=args.dual,
+                                  sym=args.dual_sym)
     if args.load:
         siamese_gnn = logger.load_model(args.path_load)
     if torch.cuda.is_available():
@@ -243,3 +286,8 @@ if __name__ == '__main__':
         train(siamese_gnn, logger, gen)
     # elif args.mode == 'test':
     #     test(siamese_gnn, logger, gen)
+    if args.export:
+        # traced on a sample batch, see Logger.export_model
+        example = gen.sample_batch(batch_size, is_training=False,
+                                   cuda=torch.cuda.is_available())
+        logger.export_model(siamese_gnn, example[0])
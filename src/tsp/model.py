@@ -9,6 +9,8 @@ import unicodedata
 import string
 import re
 import random
+import math
+import copy
 
 import torch
 import torch.nn as nn
@@ -35,20 +37,125 @@ def sinkhorn_knopp(A, iterations=1):
         A = A.view(*A_size).permute(0, 2, 1)
     return A
 
+def prepare_operators(W):
+    # W is a tensor of size (bs, N, N, J). Row n*J + j of the result is row n
+    # of operator j, so the product with x is already laid out as
+    # (bs, N, J*num_features) and no split/cat is needed.
+    W_size = W.size()
+    W = W.permute(0, 1, 3, 2).contiguous()
+    return W.view(W_size[0], W_size[1]*W_size[3], W_size[2])
+
+class GraphOperators(object):
+    """ Operators {Id, W, W^2, ..., W^{J-1}, D, U} of a batch of graphs where
+    only the powers are stored, laid out as in prepare_operators in a
+    (bs, N*(J-1), N) tensor that can be dense or sparse COO. The identity,
+    the degree operator D = diag(d) and the mean operator U = ones/N are
+    applied in closed form, so a graph multiply costs O((E + N) J F) with
+    sparse powers. """
+    def __init__(self, powers, degrees):
+        self.powers = powers
+        # degrees is a tensor of size (bs, N)
+        self.degrees = degrees
+
+    @staticmethod
+    def from_dense(W):
+        # W is a tensor of size (bs, N, N, J+2) from compute_operators
+        J = W.size()[-1] - 2
+        powers = prepare_operators(W[:, :, :, 1:J])
+        degrees = torch.diagonal(W[:, :, :, J], dim1=1, dim2=2)
+        return GraphOperators(powers, degrees)
+
+    def to_sparse(self):
+        return GraphOperators(self.powers.to_sparse(), self.degrees)
+
+    def cuda(self):
+        return GraphOperators(self.powers.cuda(), self.degrees.cuda())
+
+    def adjacency(self):
+        # the first power, of size (bs, N, N); the powers must be dense
+        bs, N = self.degrees.size()
+        return self.powers.view(bs, N, -1, N)[:, :, 0]
+
+    def mul(self, x):
+        # x is a tensor of size (bs, N, num_features)
+        x_size = x.size()
+        powers = torch.bmm(self.powers, x).view(x_size[0], x_size[1], -1)
+        degrees = self.degrees.unsqueeze(2) * x
+        mean = x.mean(1, keepdim=True).expand_as(x)
+        # same feature order as the dense operator stack
+        return torch.cat((x, powers, degrees, mean), 2)
+
+class LineGraphOperators(object):
+    """ Operators {Id, L, L^2, L^4, ..., D, U} of the line graph of the
+    complete graph on N cities, as built by compute_operators in dual mode,
+    without materializing any E x E matrix (E = N(N-1)/2). L = B^T B - 2I,
+    with B the N x E incidence matrix, is applied as a scatter of the edge
+    features to their two cities (B x) followed by a gather back to the
+    edges (B^T), so a graph multiply costs O(J E F). """
+    def __init__(self, N, J):
+        self.N = N
+        self.J = J
+        # edges (i, j), i < j, in row-major order, as in adj_from_coord
+        self.rows, self.cols = torch.triu_indices(N, N, 1)
+        # every edge shares a city with 2(N-2) others
+        self.degree = 2.0 * (N - 2)
+        self.scales = self.power_scales()
+
+    def line_mul(self, x):
+        # L x for x of size (bs, E, num_features)
+        nodes = x.new_zeros(x.size()[0], self.N, x.size()[2])
+        nodes = nodes.index_add(1, self.rows, x).index_add(1, self.cols, x)
+        return nodes[:, self.rows] + nodes[:, self.cols] - 2 * x
+
+    def power_scales(self):
+        """ compute_operators stores the powers normalized, channel j + 1
+        holding a_j L^(2^j) with a_0 = 1 and a_j = sqrt(2) / max(L^(2^j)).
+        The line graph is edge transitive, so every column of a power of L
+        is a permutation of the first one and the max is that of L^m e_0. """
+        E = self.rows.size()[0]
+        v = torch.zeros(1, E, 1, dtype=torch.float64)
+        v[0, 0, 0] = 1
+        scales, m = [1.0], 1
+        v = self.line_mul(v)
+        for j in range(self.J - 2):
+            for k in range(m):
+                v = self.line_mul(v)
+            m *= 2
+            scales.append(math.sqrt(2) / v.max().item())
+        return scales
+
+    def cuda(self):
+        ops = copy.copy(self)
+        ops.rows, ops.cols = self.rows.cuda(), self.cols.cuda()
+        return ops
+
+    def mul(self, x):
+        # x is a tensor of size (bs, E, num_features)
+        outputs = [x]
+        y, m = self.line_mul(x), 1
+        for j in range(self.J - 1):
+            if j > 0:
+                for k in range(m):
+                    y = self.line_mul(y)
+                m *= 2
+            outputs.append(self.scales[j] * y)
+        outputs.append(self.degree * x)
+        outputs.append(x.mean(1, keepdim=True).expand_as(x))
+        # same feature order as the dense operator stack
+        return torch.cat(outputs, 2)
+
 def gmul(input):
     W, x = input
     # x is a tensor of size (bs, N, num_features)
-    # W is a tensor of size (bs, N, N, J)
+    # W is a tensor of size (bs, N*J, N), see prepare_operators, the raw
+    # (bs, N, N, J) operators or a GraphOperators
+    if isinstance(W, (GraphOperators, LineGraphOperators)):
+        return W.mul(x)
+    if W.dim() == 4:
+        W = prepare_operators(W)
     x_size = x.size()
-    W_size = W.size()
-    N = W_size[-2]
-    J = W_size[-1]
-    W = W.split(1, 3)
-    W = torch.cat(W, 1).squeeze(3) # W is now a tensor of size (bs, J*N, N)
-    output = torch.bmm(W, x) # output has size (bs, J*N, num_features)
-    output = output.split(N, 1)
-    output = torch.cat(output, 2) # output has size (bs, N, J*num_features)
-    return output
+    output = torch.bmm(W, x) # output has size (bs, N*J, num_features)
+    return output.view(x_size[0], x_size[1], -1) # (bs, N, J*num_features)
 
 def normalize_embeddings(emb):
     norm = torch.mul(emb, emb).sum(2).unsqueeze(2).sqrt().expand_as(emb)
@@ -95,6 +202,42 @@ class Gconv(nn.Module):
         x = self.bn_instance(x.permute(0, 2, 1)).permute(0, 2, 1)
         return W, x
 
+class Gconv_fused(nn.Module):
+    """ Eval-mode Gconv doing one GEMM: fc1 and fc2 are packed into a single
+    linear layer and the relu is applied to its first half in place. The
+    instance norm depends on every input, so it is kept as is. """
+    def __init__(self, gconv):
+        super(Gconv_fused, self).__init__()
+        self.num_inputs = gconv.num_inputs
+        self.num_outputs = gconv.num_outputs
+        self.half = gconv.fc1.out_features
+        self.fc = nn.Linear(self.num_inputs, self.num_outputs)
+        self.fc.weight.data = torch.cat((gconv.fc1.weight.data,
+                                         gconv.fc2.weight.data))
+        self.fc.bias.data = torch.cat((gconv.fc1.bias.data,
+                                       gconv.fc2.bias.data))
+        self.bn_instance = gconv.bn_instance
+
+    def forward(self, input):
+        W = input[0]
+        x = gmul(input) # out has size (bs, N, num_inputs)
+        x_size = x.size()
+        x = self.fc(x.view(-1, self.num_inputs))
+        x[:, :self.half] = F.relu(x[:, :self.half])
+        x = x.view(*x_size[:-1], self.num_outputs)
+        x = self.bn_instance(x.permute(0, 2, 1)).permute(0, 2, 1)
+        return W, x
+
+def fuse_model(model):
+    """ Inference copy of a trained model in eval mode where every Gconv is
+    replaced by a Gconv_fused. """
+    model = copy.deepcopy(model).eval()
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Gconv):
+                setattr(module, name, Gconv_fused(child))
+    return model
+
 class GNN(nn.Module):
     def __init__(self, num_features, num_layers, J, dim_input=1):
         super(GNN, self).__init__()
@@ -110,6 +253,9 @@ class GNN(nn.Module):
         self.layerlast = Gconv_last(self.featuremap_end, J)
 
     def forward(self, input):
+        # the operators are laid out for bmm once and shared by all layers
+        if not isinstance(input[0], (GraphOperators, LineGraphOperators)):
+            input = [prepare_operators(input[0]), input[1]]
         cur = self.layer0(input)
         for i in range(self.num_layers):
             cur = self._modules['layer{}'.format(i+1)](cur)
@@ -118,33 +264,41 @@ class GNN(nn.Module):
 
 class Siamese_GNN(nn.Module):
     def __init__(self, num_features, num_layers, N, J,
-                 dim_input=1, dual=False):
+                 dim_input=1, dual=False, sym=False):
         super(Siamese_GNN, self).__init__()
         self.N = N
         self.dual = dual
+        # in dual mode, also write the edge scores below the diagonal
+        self.sym = sym
         if self.dual:
             dim_input=1
         self.gnn = GNN(num_features, num_layers, J, dim_input=dim_input)
         self.linear_dual = nn.Linear(num_features, 1)
 
-    def forward(self, g1, g2):
-        emb1 = self.gnn(g1)
-        # embx are tensors of size (bs, N, num_features)
+    def embed(self, g):
+        # node embeddings of size (bs, N, num_features), or edge embeddings
+        # of the line graph in dual mode
+        return self.gnn(g)
+
+    def edge_logits(self, emb1):
         if self.dual:
             emb_size = emb1.size()
             emb1 = emb1.view(-1, emb_size[-1])
             emb1 = self.linear_dual(emb1)
             emb1 = emb1.view(*emb_size[:2], 1)
-            # reshape edge embeddings
+            # scatter the edge scores, ordered as the (i, j), i < j, pairs
+            # in row-major order, to the upper triangle
             batch_size = emb1.size()[0]
-            out = Variable(torch.zeros(batch_size, self.N, self.N)).type(dtype)
-            for b in range(batch_size):
-                count = 0
-                for i in range(0, self.N-1):
-                    for j in range(i+1, self.N):
-                        # print(i, j)
-                        out[b, i, j] = emb1[b, count]
-                        count +=1
+            rows, cols = torch.triu_indices(self.N, self.N, 1,
+                                            device=emb1.device)
+            edges = rows*self.N + cols
+            scores = emb1.view(batch_size, -1)
+            out = emb1.new_zeros(batch_size, self.N*self.N)
+            out = out.index_add(1, edges, scores)
+            # models saved before sym existed have no such attribute
+            if getattr(self, 'sym', False):
+                out = out.index_add(1, cols*self.N + rows, scores)
+            out = out.view(batch_size, self.N, self.N)
         else:
             # l2normalize the embeddings
             emb1 = normalize_embeddings(emb1)
@@ -156,19 +310,31 @@ class Siamese_GNN(nn.Module):
             # print('out', out[0])
         return out # out has size (bs, N, N)
 
+    def forward(self, g, g2=None):
+        # the graph is scored once, g2 is only accepted for compatibility
+        # with the former pair input
+        return self.edge_logits(self.embed(g))
+
 class Siamese_2GNN(nn.Module):
     def __init__(self, num_features, num_layers, J, dim_input=1):
         super(Siamese_2GNN, self).__init__()
         self.gnn1 = GNN(num_features, num_layers, J, dim_input=dim_input)
         self.gnn2 = GNN(num_features, num_layers, J, dim_input=dim_input)
 
-    def forward(self, g1, g2):
-        emb1 = self.gnn1(g1)
-        emb2 = self.gnn2(g2)
+    def embed(self, g1, g2=None):
+        # two towers, by default on the same graph
+        if g2 is None:
+            g2 = g1
+        return self.gnn1(g1), self.gnn2(g2)
+
+    def edge_logits(self, emb1, emb2):
         # embx are tensors of size (bs, N, num_features)
         out = torch.bmm(emb1, emb2.permute(0, 2, 1))
         return out # out has size (bs, N, N)
 
+    def forward(self, g1, g2=None):
+        return self.edge_logits(*self.embed(g1, g2))
+
 if __name__ == '__main__':
     # test modules
     bs =  4
@@ -197,11 +363,22 @@ if __name__ == '__main__':
     # out = gnn(input)
     # print(out.size())
     ######################### test siamese gnn ##############################
+    ######################### test fused gconv ############################
+    siamese_gnn = Siamese_GNN(num_features, num_layers, N, J)
+    siamese_gnn.eval()
+    x = torch.rand((bs, N, 1))
+    input = [Variable(W), Variable(x)]
+    out = siamese_gnn(input)
+    out_fused = fuse_model(siamese_gnn)(input)
+    print('fused error', ((out - out_fused).abs().max() / out.abs().max()))
+    ######################### test siamese gnn ##############################
     x = torch.ones((bs, N, 1))
-    input1 = [Variable(W), Variable(x)]
-    input2 = [Variable(W.clone()), Variable(x.clone())]
-    siamese_gnn = Siamese_GNN(num_features, num_layers, J)
-    out = siamese_gnn(input1, input2)
+    input = [Variable(W), Variable(x)]
+    siamese_gnn = Siamese_GNN(num_features, num_layers, N, J)
+    out = siamese_gnn(input)
+    print(out.size())
+    siamese_2gnn = Siamese_2GNN(num_features, num_layers, J)
+    out = siamese_2gnn(input)
     print(out.size())
 
 
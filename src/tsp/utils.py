@@ -123,52 +123,199 @@ def greedy(pred, W):
     return Costs, Paths
     
 
+def compute_tour_costs(paths, W):
+    """ Costs of the closed tours paths, of size (B, T, N), under the
+    weights W of size (B, N, N), including the edge from the last node back
+    to the first. Returns a (B, T) tensor. """
+    B, T, N = paths.size()
+    nxt = torch.cat((paths[:, :, 1:], paths[:, :, :1]), 2)
+    edges = (paths * N + nxt).view(B, T * N)
+    costs = W.contiguous().view(B, N * N).gather(1, edges)
+    return costs.view(B, T, N).sum(2)
+
 def compute_cost_path(Paths, W):
-    # Paths is a list of length N+1
-    batch_size = W.size(0)
-    N = W.size(-1)
-    Costs = torch.zeros(batch_size)
-    for b in range(batch_size):
-        path = Paths[b].squeeze(0)
-        Wb = W[b].squeeze(0)
-        cost = 0.0
-        for node in range(N-1):
-            start = path[node]
-            end = path[node + 1]
-            cost += Wb[start, end]
-        cost += Wb[end, 0]
-        Costs[b] = cost
-    return Costs
+    # Paths has size (B, N), one tour per instance
+    return compute_tour_costs(Paths.unsqueeze(1), W)[:, 0]
 
-def beamsearch_hamcycle(pred, W, beam_size=2):
-    N = W.size(-1)
-    batch_size = W.size(0)
-    BS = BeamSearch(beam_size, batch_size, N)
-    trans_probs = pred.gather(1, BS.get_current_state())
+def compute_path_probability(pred, paths):
+    """ Log-probability of the (B, T, N) paths, starting at their first node,
+    under the policy that moves from a node to an unvisited one with
+    probability proportional to sigmoid(pred) + 1e-6. The closing edge is
+    not scored. Returns a (B, T) tensor. """
+    pred = F.sigmoid(pred) + 1e-6
+    Bs, T, N = paths.size()
+    starts = paths[:, :, :-1]
+    ends = paths[:, :, 1:]
+    # rows[b, t, s] = pred[b, paths[b, t, s]], of size (B, T, N-1, N)
+    rows = pred.unsqueeze(1).expand(Bs, T, N, N)
+    rows = rows.gather(2, starts.unsqueeze(3).expand(Bs, T, N - 1, N))
+    # at step s the nodes placed at positions > s are still unvisited
+    steps = torch.arange(N, device=paths.device).expand(Bs, T, N)
+    position = torch.zeros_like(paths).scatter_(2, paths, steps)
+    remaining = (position.unsqueeze(2) > steps[:, :, :-1].unsqueeze(3))
+    norm = (rows * remaining.type_as(rows)).sum(3)
+    prob = rows.gather(3, ends.unsqueeze(3)).squeeze(3)
+    return (torch.log(prob) - torch.log(norm)).sum(2)
+
+def beamsearch_tours(pred, beam_size=2):
+    """ The beam_size most likely tours, best first, under the policy of
+    compute_path_probability, as a (B, beam_size, N) tensor. """
+    N = pred.size(-1)
+    batch_size = pred.size(0)
+    weights = F.sigmoid(pred) + 1e-6
+    BS = BeamSearch(beam_size, batch_size, N, device=pred.device)
+    for step in range(N-1):
+        current = BS.get_current_state()
+        BS.advance(weights.gather(1, current.unsqueeze(2)
+                                  .expand(batch_size, beam_size, N)))
+    return BS.get_hyps()
+
+def sample_tours(pred, n_samples):
+    """ Draws n_samples tours per instance, all in parallel, from the policy
+    of compute_path_probability. Returns the (B, n_samples, N) tours and
+    their (B, n_samples) log-probabilities, differentiable w.r.t. pred. """
+    N = pred.size(-1)
+    batch_size = pred.size(0)
+    weights = F.sigmoid(pred) + 1e-6
+    current = torch.zeros(batch_size, n_samples, 1, dtype=torch.long,
+                          device=pred.device)
+    visited = torch.zeros(batch_size, n_samples, N, dtype=torch.bool,
+                          device=pred.device)
+    visited[:, :, 0] = True
+    nodes = [current]
+    logp = 0
     for step in range(N-1):
-        BS.advance(trans_probs, step + 1)
-        trans_probs = pred.gather(1, BS.get_current_state())
-    ends = torch.zeros(batch_size, 1).type(dtype_l)
-    # extract paths
-    Paths = BS.get_hyp(ends)
+        rows = weights.gather(1, current.expand(batch_size, n_samples, N))
+        rows = rows.masked_fill(visited, 0)
+        current = torch.multinomial(rows.detach().view(-1, N), 1)
+        current = current.view(batch_size, n_samples, 1)
+        logp = logp + (torch.log(rows.gather(2, current)) -
+                       torch.log(rows.sum(2, keepdim=True)))
+        nodes.append(current)
+        # out of place, autograd keeps the mask of every step
+        visited = visited.scatter(2, current, True)
+    return torch.cat(nodes, 2), logp.squeeze(2)
+
+def sample_hamcycles(pred, W, n_samples):
+    Paths, logp = sample_tours(pred, n_samples)
+    Costs = compute_tour_costs(Paths, W)
+    return Costs, Paths, logp
+
+def beamsearch_hamcycle(pred, W, beam_size=2):
+    Paths = beamsearch_tours(pred, beam_size=beam_size)[:, 0]
     # Compute cost of path
     Costs = compute_cost_path(Paths, W)
     return Costs, Paths
 
 def beamsearch_hamcycles(pred, W, n_paths, beam_size=2):
-    N = W.size(-1)
-    batch_size = W.size(0)
-    BS = BeamSearch(beam_size, batch_size, N)
-    trans_probs = pred.gather(1, BS.get_current_state())
-    for step in range(N-1):
-        BS.advance(trans_probs, step + 1)
-        trans_probs = pred.gather(1, BS.get_current_state())
-    Paths = torch.zeros(batch_size, n_paths, N).type(dtype_l)
-    Costs = torch.zeros(batch_size, n_paths).type(dtype_l)
-    for t in range(n_paths):
-        ends = t*torch.ones(batch_size, 1).type(dtype_l)
-        # extract paths
-        Paths[:,t] = BS.get_hyp(ends)
-        # Compute cost of path
-        Costs[:,t] = compute_cost_path(Paths[:,t], W)
-    return Costs, Paths
\ No newline at end of file
+    # at most beam_size distinct paths
+    Paths = beamsearch_tours(pred, beam_size=beam_size)[:, :n_paths]
+    # Compute cost of paths
+    Costs = compute_tour_costs(Paths, W)
+    return Costs, Paths
+
+def two_opt_moves(paths, W):
+    """ Change of tour cost of every 2-opt move of the (B, N) tours under the
+    symmetric weights W. Entry (i, j) reverses the tour between positions
+    i+1 and j, replacing edges (t_i, t_i+1), (t_j, t_j+1) by (t_i, t_j),
+    (t_i+1, t_j+1); moves that would change position 0 are -inf. """
+    B, N = paths.size()
+    nxt = torch.cat((paths[:, 1:], paths[:, :1]), 1)
+    rows = W.gather(1, paths.unsqueeze(2).expand(B, N, N))
+    Wpp = rows.gather(2, paths.unsqueeze(1).expand(B, N, N))
+    rows = W.gather(1, nxt.unsqueeze(2).expand(B, N, N))
+    Wnn = rows.gather(2, nxt.unsqueeze(1).expand(B, N, N))
+    edges = W.contiguous().view(B, N * N).gather(1, paths * N + nxt)
+    delta = Wpp + Wnn - edges.unsqueeze(2) - edges.unsqueeze(1)
+    i = torch.arange(N, device=paths.device)
+    valid = i.unsqueeze(0) > i.unsqueeze(1) + 1
+    # reversing positions 1..N-1 only flips the direction of the tour
+    valid[0, N - 1] = False
+    return delta.masked_fill(~valid, -float('inf'))
+
+def or_opt_moves(paths, W, max_length=3):
+    """ Change of tour cost of every Or-opt move of the (B, N) tours under
+    the weights W, as a (B, max_length, N, N, 2) tensor. Entry
+    (l, i, j, r) moves the l+1 nodes at positions i..i+l between positions
+    j and j+1, reversed if r is 1. Invalid moves are -inf. """
+    B, N = paths.size()
+    pos = torch.arange(N, device=paths.device)
+    flat = W.contiguous().view(B, N * N)
+    def weight(u, v):
+        # W[b, u[b, ...], v[b, ...]] for index tensors of equal shape
+        idx = (u * N + v).view(B, -1)
+        return flat.gather(1, idx).view(u.size())
+    nxt = paths[:, (pos + 1) % N]
+    link = weight(paths, nxt) # link[:, j] joins positions j and j+1
+    moves = []
+    for l in range(max_length):
+        last = (pos + l) % N
+        first_node = paths
+        last_node = paths[:, last]
+        prev_node = paths[:, (pos - 1) % N]
+        next_node = paths[:, (pos + l + 1) % N]
+        # gain of closing the gap left by the segment starting at i
+        removal = (weight(prev_node, next_node) - link[:, (pos - 1) % N] -
+                   link[:, last])
+        s = first_node.unsqueeze(2).expand(B, N, N)
+        e = last_node.unsqueeze(2).expand(B, N, N)
+        u = paths.unsqueeze(1).expand(B, N, N)
+        v = nxt.unsqueeze(1).expand(B, N, N)
+        forward = weight(u, s) + weight(e, v)
+        backward = weight(u, e) + weight(s, v)
+        insertion = torch.stack((forward, backward), 3)
+        delta = (removal.unsqueeze(2).unsqueeze(3) + insertion -
+                 link.unsqueeze(1).unsqueeze(3))
+        # position 0 stays, j must not touch the segment or the gap
+        i, j = pos.unsqueeze(1), pos.unsqueeze(0)
+        valid = (i >= 1) & (i + l <= N - 1) & ((j < i - 1) | (j > i + l))
+        moves.append(delta.masked_fill(~valid.unsqueeze(2), -float('inf')))
+    return torch.stack(moves, 1)
+
+def local_search(paths, W, max_iter=100, or_opt=False):
+    """ Improves the (B, N) tours with best-improvement 2-opt, and Or-opt
+    moves of up to 3 nodes if or_opt, keeping position 0 fixed. W is
+    sqrt(2) minus the distance, so a move improves the tour if it
+    increases the sum of W. All candidate moves of all tours are evaluated
+    at once; every tour takes its best move until it reaches a local
+    optimum or max_iter moves, which may be an int or a (B,) tensor of
+    per-instance caps. Returns the tours and the number of moves done. """
+    B, N = paths.size()
+    if not torch.is_tensor(max_iter):
+        max_iter = torch.full((B,), max_iter, dtype=torch.long)
+    max_iter = max_iter.to(paths.device)
+    iterations = torch.zeros(B, dtype=torch.long, device=paths.device)
+    pos = torch.arange(N, device=paths.device).expand(B, N)
+    while True:
+        delta = two_opt_moves(paths, W).view(B, -1)
+        gain, move = delta.max(1)
+        if or_opt:
+            delta = or_opt_moves(paths, W).view(B, -1)
+            gain_or, move_or = delta.max(1)
+            use_or = gain_or > gain
+            gain = torch.max(gain, gain_or)
+        active = (gain > 1e-6) & (iterations < max_iter)
+        if not active.any():
+            break
+        # 2-opt: reverse positions i+1..j
+        i, j = move // N, move % N
+        lo, hi = (i + 1).unsqueeze(1), j.unsqueeze(1)
+        inside = (pos >= lo) & (pos <= hi)
+        order = torch.where(inside, lo + hi - pos, pos)
+        if or_opt:
+            # Or-opt: sort positions by a key placing the segment after j
+            m, r = move_or // 2, move_or % 2
+            l, m = m // (N * N), m % (N * N)
+            i_or, j_or = (m // N).unsqueeze(1), (m % N).unsqueeze(1)
+            l, r = l.unsqueeze(1), r.unsqueeze(1)
+            segment = (pos >= i_or) & (pos <= i_or + l)
+            offset = (pos - i_or).float()
+            offset = torch.where(r == 1, l.float() - offset, offset)
+            key = torch.where(segment, j_or.float() + 0.5 +
+                              offset / (N + 1), pos.float())
+            order_or = key.argsort(1)
+            order = torch.where(use_or.unsqueeze(1), order_or, order)
+        order = torch.where(active.unsqueeze(1), order, pos)
+        paths = paths.gather(1, order)
+        iterations += active.long()
+    return paths, iterations